@@ -1,23 +1,25 @@
-# Auto Chap V4.3
+# Auto Chap V5.0
 import sys
 import json
 import os
-import urllib
+import urllib.parse
 import time
-import warnings
 import argparse
 import shutil
 import math
+import hashlib
+import re
+import glob
+import copy
+import threading
+import itertools
+import queue
 from pathlib import Path
-import requests
 import subprocess
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
-import librosa
 import audioread.ffdec
 import numpy as np
-from scipy import signal
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
+# scipy, matplotlib and requests are slow to import so they only get imported where they're used
 
 ### Chapter Names
 PRE_OP = "Prologue"
@@ -26,20 +28,50 @@ EPISODE = "Episode"
 ENDING = "Ending"
 POST_ED = "Epilogue"
 
-# Ignore librosa warnings about audioread. Try downgrading to librosa < 1.0 if it fully breaks
-warnings.filterwarnings("ignore", category=FutureWarning)
-warnings.filterwarnings("ignore", category=UserWarning)
+### Coarse to fine matching
+COARSE_CANDIDATES = 3 # Peaks from the coarse search that get refined
+REFINE_WINDOW = 2 # Seconds either side of a coarse peak to search at full rate
+
+### Normalized matching
+CONFIDENCE = 0.2 # Normalized correlation needed to match with --normalize, 1 is a perfect copy
+
+### Fingerprinting
+FINGERPRINT_FAN_OUT = 5 # Peaks each landmark peak gets paired with
+FINGERPRINT_MAX_DT = 63 # Furthest apart in frames two paired peaks can be
+FINGERPRINT_MIN_VOTES = 10 # Votes needed for a theme to be worth verifying
+FINGERPRINT_CANDIDATES = 3 # Most themes of each type that get verified
+
+### Match cache
+MATCH_CACHE_PEAKS = 5 # Highest correlation peaks kept for every episode and theme
+
+### Downloads
+DOWNLOAD_TIMEOUT = (10, 60) # Seconds to connect and to wait between bytes
+DOWNLOAD_RETRIES = 5 # Retries after the first try before giving up on a theme
+DOWNLOAD_BACKOFF = 1 # Seconds to wait before the first retry, doubles every retry
+DOWNLOAD_MAX_BACKOFF = 30 # Longest wait between retries
+DOWNLOAD_CHUNK = 1 << 16 # Bytes written to disk at a time
+
+### Snapping
+SNAP_CHUNK = 12 # Frames SCXvid looks at per step when scanning out from a chapter
+SNAP_NUMPY_CHUNK = 48 # Frames the numpy backend decodes per step, more than SCXvid since every step seeks ffmpeg again
+SCENE_CHANGE_THRESHOLD = 0.1 # Score a frame needs to count as a scene change with the numpy backend, like 10 in ffmpeg's scdet
+
+### Charts
+CHART_POINTS = 4000 # Points a correlation curve gets reduced to before plotting
+
+# Files picked up when a folder is given as input
+EPISODE_EXTENSIONS = (".mkv", ".mp4", ".webm", ".avi", ".m4a", ".mka", ".flac", ".wav")
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Automatic anime chapter generator using AnimeThemes.")
     parser.add_argument(
-        "--input", "-i", type=Path, required=True,
-        help="Video/Audio file.",
+        "--input", "-i", type=Path,
+        help="Video/Audio file. Give a folder or a quoted glob like \"Season 1/*.mkv\" to generate chapters for a whole batch of episodes at once.",
     )
 
     parser.add_argument(
         "--output", "-o", type=Path,
-        help="Output chapter file. Defaults to where the episode is.",
+        help="Output chapter file. Defaults to where the episode is. For batches this is a folder to put the chapter files in.",
     )
 
     parser.add_argument(
@@ -54,7 +86,17 @@ def parse_args():
 
     parser.add_argument(
         "--snap", type=int, nargs='?', const=1000, default=None,
-        help="Millisecond window to snap to nearest keyframe for frame-perfect chapters. Efficiently generates necessary keyframes from video. Defaults to 1000ms if no value added. Values higher than about 1000 currently crash.",
+        help="Millisecond window to snap to nearest keyframe for frame-perfect chapters. Efficiently generates necessary keyframes from video. Defaults to 1000ms if no value added.",
+    )
+
+    parser.add_argument(
+        "--snap-backend", type=str, choices=["scxvid", "numpy"], default="scxvid",
+        help="How to find scene changes when snapping. scxvid needs VapourSynth with ffms2 and SCXvid. numpy only needs ffmpeg and decodes just the frames around each chapter. Defaults to scxvid.",
+    )
+
+    parser.add_argument(
+        "--snap-height", type=int, default=360,
+        help="Height frames get resized to before looking for scene changes when snapping. Lower is faster and 180 is usually still accurate. Defaults to 360.",
     )
 
     parser.add_argument(
@@ -67,6 +109,16 @@ def parse_args():
         help="Score required for a theme to be accepted as a match. Increase it to reduce false positives, decrease it to be more lenient. Score is y-axis in charts divided by downsample factor. Defaults to 2000.",
     )
 
+    parser.add_argument(
+        "--normalize", default=False, action="store_true",
+        help="Score matches with normalized cross-correlation, a confidence from 0 to 1 that doesn't depend on how loud the episode or theme is or the downsample factor. Uses --confidence instead of --score and stays reliable at much higher downsample factors.",
+    )
+
+    parser.add_argument(
+        "--confidence", type=float, default=CONFIDENCE,
+        help=f"Confidence required for a theme to be accepted as a match with --normalize. Confidence is y-axis in charts. Defaults to {CONFIDENCE}.",
+    )
+
     parser.add_argument(
         "--theme-portion", type=float, default=0.9,
         help="Portion of a theme required in the episode to be a match. Keep below 1 so that it can still match themes that get slightly cut off. Defaults to 0.9."
@@ -77,11 +129,81 @@ def parse_args():
         help="Factor to downsample audio when matching, higher means speedier potentially with lower accuracy. Defaults to 32.",
     )
 
+    parser.add_argument(
+        "--coarse-downsample", type=int, nargs='?', const=256, default=None,
+        help="Find candidate matches in audio downsampled by this factor first then only refine around them with the normal downsample factor. Much faster with the same precision. Defaults to 256 if no value added.",
+    )
+
+    parser.add_argument(
+        "--search-window", type=float, nargs='?', const=0.5, default=None,
+        help="Only search for OPs starting in this leading portion of the episode and EDs in the trailing portion, falling back to the whole episode if nothing scores high enough. Defaults to 0.5 if no value added.",
+    )
+
+    parser.add_argument(
+        "--fingerprint", "-f", default=False, action="store_true",
+        help="Look up themes in a spectral fingerprint index of the .themes folder first and only verify the best candidates with the normal matching. Keeps matching fast for series with lots of themes.",
+    )
+
+    parser.add_argument(
+        "--no-match-cache", default=False, action="store_true",
+        help="Correlate every theme again instead of reusing the results from earlier runs on the same episode audio.",
+    )
+
+    parser.add_argument(
+        "--max-memory", type=float,
+        help="Megabytes matching can use. The episode gets decoded and correlated a block at a time and only the best peaks are kept, so memory stays the same however long the episode is. For movies or small machines.",
+    )
+
+    parser.add_argument(
+        "--jobs", "-j", type=int, default=4,
+        help="How many themes to match in parallel. Once a theme matches, the rest of that type get cancelled. Defaults to 4.",
+    )
+
+    parser.add_argument(
+        "--match-backend", type=str, choices=["threads", "processes"], default="threads",
+        help="Match themes in parallel with threads or processes. processes puts the episode in shared memory once and scales better with many jobs and cores since everything around the FFTs doesn't hold the other jobs up. Defaults to threads.",
+    )
+
+    parser.add_argument(
+        "--fft-threads", type=int, default=1,
+        help="Threads each theme match uses for its FFTs. Defaults to 1.",
+    )
+
+    parser.add_argument(
+        "--api-url", type=str, default="https://api.animethemes.moe",
+        help="AnimeThemes API to use. Only needs changing to test against a local stand-in like benchmarks/animethemes_stub.py.",
+    )
+
+    parser.add_argument(
+        "--api-cache-ttl", type=float, default=60,
+        help="Minutes to reuse cached AnimeThemes search results before checking with the API if they changed. The cached results are still used if the API can't be reached. Defaults to 60.",
+    )
+
+    parser.add_argument(
+        "--theme-store", type=Path, default=Path(os.environ.get("XDG_CACHE_HOME", Path.home() / ".cache")) / "Auto_Chap" / "themes",
+        help="Folder every downloaded theme is kept in and shared between series and work paths, so switching series or sharing an OP with another season never downloads it again. Defaults to Auto_Chap/themes in your cache folder.",
+    )
+
+    parser.add_argument(
+        "--theme-store-size", type=float, default=2000,
+        help="Megabytes the theme store can grow to before the least recently used themes get removed from it. 0 for no limit. Defaults to 2000.",
+    )
+
+    parser.add_argument(
+        "--gc-theme-store", default=False, action="store_true",
+        help="Remove themes from the theme store that no series uses anymore, then the least recently used ones until it fits in --theme-store-size, then exit.",
+    )
+
     parser.add_argument(
         "--parallel-dl", type=int, default=10,
         help="How many themes to download in parallel. Defaults to 10.",
     )
 
+    parser.add_argument(
+        "--parallel-episodes", type=int, default=4,
+        help="How many episodes to match in parallel when given a batch. Defaults to 4.",
+    )
+
     parser.add_argument(
         "--work-path", "-w", type=Path,
         help="Place to create a .themes folder for storing persistent information per series. Defaults to where the episode is.",
@@ -94,24 +216,99 @@ def parse_args():
 
     parser.add_argument(
         "--charts", "-c", default=False, action="store_true",
-        help="Make charts of where themes are matched in the episode. They can almost double processing time in some cases though.",
+        help="Make charts of where themes are matched in the episode. They are drawn in the background so matching doesn't wait for them.",
+    )
+
+    parser.add_argument(
+        "--chart-data", default=False, action="store_true",
+        help="Save the data for charts in the charts folder instead of drawing them. Draw them later using --render-charts.",
+    )
+
+    parser.add_argument(
+        "--render-charts", type=Path,
+        help="Draw charts from data saved with --chart-data in this folder then exit.",
     )
 
     args = parser.parse_args()
+    if args.theme_store_size < 0:
+        print("Theme store size can't be negative.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.render_charts is not None or args.gc_theme_store:
+        return args
+
+    if args.input is None:
+        parser.error("the following arguments are required: --input/-i")
+
+    if args.chart_data:
+        args.charts = True
+
     args.no_download = False
 
     if args.search_name is None:
         args.no_download = True
 
+    args.batch = False
+    args.episodes = [args.input]
+    if args.input.is_dir():
+        args.batch = True
+        args.episodes = sorted(path for path in args.input.iterdir()
+                               if path.suffix.lower() in EPISODE_EXTENSIONS and not path.name.endswith(".autochap.wav"))
+    elif not args.input.exists() and any(char in str(args.input) for char in "*?["):
+        args.batch = True
+        args.episodes = sorted(Path(path) for path in glob.glob(str(args.input)) if os.path.isfile(path))
+
+    if args.batch and len(args.episodes) == 0:
+        print(f"No episodes found in {args.input}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.jobs < 1 or args.fft_threads < 1:
+        print("Jobs and FFT threads must be at least 1.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.api_cache_ttl < 0:
+        print("API cache TTL can't be negative.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.parallel_episodes < 1:
+        print("Parallel episodes must be at least 1.", file=sys.stderr)
+        sys.exit(1)
+
     if args.work_path is None:
-        args.work_path = Path(os.path.dirname(args.input))
+        if args.input.is_dir():
+            args.work_path = args.input
+        else:
+            args.work_path = Path(os.path.dirname(args.input))
 
-    if args.output is None:
+    if args.output is None and not args.batch:
         args.output = args.input.with_name(args.input.stem + ".chapters.txt")
 
-    if args.snap is not None:
-        if args.snap > 1000:
-            print("Snap values higher than about 1000 currently crash SCXvid. Please lower it.", file=sys.stderr)
+    if args.snap is not None and args.snap < 0:
+        print("Snap can't be negative.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.snap_height < 16 or args.snap_height % 2 != 0:
+        print("Snap height must be an even number of at least 16.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.coarse_downsample is not None and args.coarse_downsample < args.downsample * 2:
+        print("Coarse downsample must be at least double the downsample factor.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.search_window is not None and not 0 < args.search_window <= 1:
+        print("Search window must be more than 0 and less than or equal to 1.", file=sys.stderr)
+        sys.exit(1)
+
+    if not 0 < args.confidence < 1:
+        print("Confidence must be more than 0 and less than 1.", file=sys.stderr)
+        sys.exit(1)
+
+    if args.max_memory is not None:
+        if args.max_memory <= 0:
+            print("Max memory must be more than 0.", file=sys.stderr)
+            sys.exit(1)
+        if args.search_window is not None or args.fingerprint or args.coarse_downsample is not None or args.match_backend == "processes":
+            print("Max memory can't be used with search window, fingerprint, coarse downsample or the processes match backend.", file=sys.stderr)
             sys.exit(1)
 
     if args.theme_portion <= 0:
@@ -121,7 +318,7 @@ def parse_args():
         print("Theme portion must be less than or equal to 1.", file=sys.stderr)
         sys.exit(1)
 
-    args.episode_audio_path = None
+    args.charts_path = args.work_path / ".themes" / "charts"
 
     return args
 
@@ -132,47 +329,288 @@ def make_folders(work_path):
     subdirectory_path = work_path / ".themes" / "charts"
     shutil.rmtree(subdirectory_path, ignore_errors=True)
     subdirectory_path.mkdir(parents=True)
+    (work_path / ".themes" / "cache").mkdir(exist_ok=True)
+    (work_path / ".themes" / "matches").mkdir(exist_ok=True)
 
-def get_series_json(args):
-    api_search_call = f"https://api.animethemes.moe/search?fields[search]=anime&q={urllib.parse.quote(args.search_name)}"
+def print_line(message):
+    # Downloads and matches print from several threads at once and print() writes the newline separately,
+    # so lines are written in one go to keep them from running together
+    sys.stderr.write(f"{message}\n")
+
+def read_stored_data(t_path):
+    try:
+        with open(os.path.join(t_path, "data.json")) as data:
+            return json.load(data)
+    except Exception:
+        return {}
+
+def read_api_cache(t_path):
+    try:
+        with open(os.path.join(t_path, "api_cache.json")) as data:
+            return json.load(data)
+    except Exception:
+        return {}
+
+def write_api_cache(t_path, api_cache):
+    os.makedirs(t_path, exist_ok=True)
+    tmp_path = os.path.join(t_path, f"api_cache.json.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as outfile:
+        json.dump(api_cache, outfile)
+    os.replace(tmp_path, os.path.join(t_path, "api_cache.json"))
+
+def cached_api_get(session, api_cache, key, url, args):
+    import requests
+
+    entry = api_cache.get(key)
+    if entry is not None and time.time() - entry["fetched_at"] < args.api_cache_ttl * 60:
+        return entry["data"]
+
+    # Past the TTL so ask the API if it changed, which costs almost nothing when it didn't
+    headers = {}
+    if entry is not None:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    try:
+        response = session.get(url, headers=headers, timeout=DOWNLOAD_TIMEOUT)
+        if response.status_code == 304 and entry is not None:
+            entry["fetched_at"] = time.time()
+            return entry["data"]
+        response.raise_for_status()
+        data = response.json()
+    except (requests.RequestException, ValueError) as exc:
+        if entry is None:
+            raise
+        age = (time.time() - entry["fetched_at"]) / 60
+        print(f"Couldn't reach api ({type(exc).__name__}), using results cached {age:.0f} minutes ago", file=sys.stderr)
+        return entry["data"]
+
+    api_cache[key] = {
+        "fetched_at": time.time(),
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "data": data,
+    }
+    return data
+
+def get_series_json(args, t_path):
+    search_name = " ".join(args.search_name.lower().split())
+    api_url = args.api_url.rstrip("/")
+    api_search_call = f"{api_url}/search?fields[search]=anime&q={urllib.parse.quote(search_name)}"
     if args.year:
         if args.year < 0:
             api_search_call += f"&filter[year-gte]={abs(args.year)}"
         else:
             api_search_call += f"&filter[year]={args.year}"
-    global_search = requests.get(api_search_call).json()
-    series_slug = global_search["search"]["anime"][0]["slug"]
-    series_json = requests.get(f"https://api.animethemes.moe/anime/{series_slug}?include=animethemes.animethemeentries.videos.audio&fields[audio]=filename,updated_at,link").json()
+
+    api_cache = read_api_cache(t_path)
+    try:
+        with get_download_session(args) as session:
+            global_search = cached_api_get(session, api_cache, f"{api_url}|search|{search_name}|{args.year}", api_search_call, args)
+            series_slug = global_search["search"]["anime"][0]["slug"]
+            series_json = cached_api_get(session, api_cache, f"{api_url}|anime|{series_slug}", f"{api_url}/anime/{series_slug}?include=animethemes.animethemeentries.videos.audio&fields[audio]=filename,updated_at,link", args)
+    finally:
+        write_api_cache(t_path, api_cache)
     return series_json["anime"]
 
-def download_theme(t_path, theme_name, url):
-    response = requests.get(url)
-    if response.status_code == 200:
-        download_path = f'{t_path}/{theme_name}'
-        download_path += ".ogg"
-        with open(download_path, "wb") as file:
-            file.write(response.content)
-        print(f"{theme_name}: Downloaded     ", file=sys.stderr)
-    else:
-        print(f"Failed to download {theme_name}. Status code:", response.status_code, file=sys.stderr)
+def get_download_session(args):
+    import requests
+
+    # One pool shared by every download so connections get reused instead of opened per theme
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=args.parallel_dl, pool_maxsize=args.parallel_dl)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+def download_theme(session, t_path, theme_name, url, version_key, stats):
+    import requests
+
+    download_path = os.path.join(t_path, theme_name + ".ogg")
+    # Partial files are named after the version so one of an older version never gets resumed
+    part_path = os.path.join(t_path, f"{theme_name}.{version_key}.ogg.part")
+    for stale_path in glob.glob(os.path.join(glob.escape(t_path), glob.escape(theme_name) + ".*.ogg.part")):
+        if stale_path != part_path:
+            os.remove(stale_path)
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        if attempt > 0:
+            time.sleep(min(DOWNLOAD_BACKOFF * 2 ** (attempt - 1), DOWNLOAD_MAX_BACKOFF))
+        try:
+            # Resume from whatever a previous try or run left behind
+            offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+            with session.get(url, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+                if response.status_code == 416:
+                    if response.headers.get("Content-Range") == f"bytes */{offset}":
+                        os.replace(part_path, download_path) # Previous try got everything before failing
+                        print_line(f"{theme_name}: Downloaded     ")
+                        return True
+                    # Partial file doesn't fit what the server has anymore so start over
+                    os.remove(part_path)
+                    continue
+                if response.status_code == 429 or response.status_code >= 500:
+                    print_line(f"{theme_name}: Server returned {response.status_code}, retrying")
+                    continue
+                if response.status_code not in (200, 206):
+                    print_line(f"Failed to download {theme_name}. Status code: {response.status_code}")
+                    return False
+                if response.status_code == 200:
+                    offset = 0 # Range was ignored so the whole file is coming
+                expected = response.headers.get("Content-Length")
+                expected = offset + int(expected) if expected is not None else None
+                with open(part_path, "ab" if offset > 0 else "wb") as file:
+                    for chunk in response.iter_content(DOWNLOAD_CHUNK):
+                        file.write(chunk)
+                        with stats["lock"]:
+                            stats["bytes"] += len(chunk)
+            if expected is not None and os.path.getsize(part_path) != expected:
+                print_line(f"{theme_name}: Download cut short, resuming")
+                continue
+            os.replace(part_path, download_path)
+            print_line(f"{theme_name}: Downloaded     ")
+            return True
+        except (requests.RequestException, OSError) as exc:
+            print_line(f"{theme_name}: {type(exc).__name__} while downloading, retrying")
+    print_line(f"Failed to download {theme_name} after {DOWNLOAD_RETRIES + 1} tries")
+    return False
+
+def write_stored_data(t_path, stored_data):
+    # Replaced in one go since themes get matched while downloads are still updating it
+    tmp_path = os.path.join(t_path, f"data.json.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as outfile:
+        json.dump(stored_data, outfile, indent=4)
+    os.replace(tmp_path, os.path.join(t_path, "data.json"))
+
+def get_store_key(link, updated_at):
+    # Series that share a theme on AnimeThemes share its audio link so it only gets stored once
+    return hashlib.sha1(f"{link}|{updated_at}".encode()).hexdigest()[:16]
 
-def download_themes(t_path, args, series_json):
+def get_store_object(args, store_key):
+    return os.path.join(args.theme_store, "objects", store_key + ".ogg")
+
+def link_file(source_path, link_path):
+    # Hard links take no extra space, a copy is only made when the store is on another drive
+    tmp_path = f"{link_path}.{os.getpid()}.tmp"
     try:
-        with open(os.path.join(t_path, "data.json")) as data:
-            stored_data = json.load(data)
-    except Exception:
-        stored_data = {}
+        os.link(source_path, tmp_path)
+    except OSError:
+        shutil.copyfile(source_path, tmp_path)
+    os.replace(tmp_path, link_path)
+
+def link_stored_theme(args, store_key, t_path, theme_name):
+    object_path = get_store_object(args, store_key)
+    try:
+        link_file(object_path, os.path.join(t_path, theme_name + ".ogg"))
+        os.utime(object_path) # Modified time is when it was last used for evicting
+        return True
+    except OSError:
+        return False
 
-    # Reset themes if series different from last time
+def store_theme(args, store_key, theme_path):
+    object_path = get_store_object(args, store_key)
+    try:
+        if not os.path.isfile(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            link_file(theme_path, object_path)
+        os.utime(object_path)
+    except OSError as exc:
+        print(f"Could not add {os.path.basename(theme_path)} to the theme store - {exc}", file=sys.stderr)
+
+def write_store_manifest(args, series_json, stored_data):
+    # Which themes each series uses so the garbage collection knows what is still needed
+    themes = {theme_name: theme_data for (theme_name, theme_data) in stored_data.items()
+              if isinstance(theme_data, dict) and "store_key" in theme_data}
+    manifests_path = os.path.join(args.theme_store, "manifests")
+    try:
+        os.makedirs(manifests_path, exist_ok=True)
+        manifest_path = os.path.join(manifests_path, f'{series_json["slug"]}.json')
+        tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as outfile:
+            json.dump({"series_name": series_json["name"], "themes": themes}, outfile, indent=4)
+        os.replace(tmp_path, manifest_path)
+    except OSError as exc:
+        print(f"Could not write theme store manifest - {exc}", file=sys.stderr)
+
+def get_store_objects(args):
+    try:
+        entries = list(os.scandir(os.path.join(args.theme_store, "objects")))
+    except OSError:
+        return []
+    objects = []
+    for entry in entries:
+        if entry.name.endswith(".ogg"):
+            stat = entry.stat()
+            objects.append((stat.st_mtime, stat.st_size, entry.path))
+    return objects
+
+def evict_theme_store(args, keep=()):
+    # Least recently used first, work paths keep their own links so evicting only costs a download later
+    if args.theme_store_size == 0:
+        return 0, 0
+    objects = sorted(get_store_objects(args))
+    total = sum(size for (_, size, _) in objects)
+    limit = args.theme_store_size * 1e6
+    evicted = 0
+    freed = 0
+    for (_, size, object_path) in objects:
+        if total <= limit:
+            break
+        if os.path.splitext(os.path.basename(object_path))[0] in keep:
+            continue
+        try:
+            os.remove(object_path)
+        except OSError:
+            continue
+        total -= size
+        evicted += 1
+        freed += size
+    return evicted, freed
+
+def gc_theme_store(args):
+    used = set()
+    manifests_path = os.path.join(args.theme_store, "manifests")
+    if os.path.isdir(manifests_path):
+        for manifest_file in os.scandir(manifests_path):
+            if not manifest_file.name.endswith(".json"):
+                continue
+            try:
+                with open(manifest_file.path) as data:
+                    used.update(theme_data["store_key"] for theme_data in json.load(data)["themes"].values())
+            except Exception as exc:
+                print(f"Skipping {manifest_file.name} - {exc}", file=sys.stderr)
+
+    removed = 0
+    freed = 0
+    objects_path = os.path.join(args.theme_store, "objects")
+    if os.path.isdir(objects_path):
+        for object_file in os.scandir(objects_path):
+            # Leftovers from runs that got killed while adding a theme count as unused too
+            if object_file.name.endswith(".tmp") or os.path.splitext(object_file.name)[0] not in used:
+                size = object_file.stat().st_size
+                os.remove(object_file.path)
+                removed += 1
+                freed += size
+
+    evicted, evicted_size = evict_theme_store(args)
+    print(f"Removed {removed} unused and {evicted} least recently used themes from {args.theme_store}, freed {(freed + evicted_size) / 1e6:.1f} MB")
+
+def download_themes(t_path, args, series_json, theme_ready=None):
+    stored_data = read_stored_data(t_path)
+
+    # Swap out the themes if series different from last time, they are all in the theme store so
+    # switching back doesn't download anything. Decoded themes are cached by version so they can stay
     if stored_data.get("series_name") != series_json["name"]:
         stored_data = {"series_name": series_json["name"]}
         files = os.listdir(t_path)
         for file in files:
-            if file.endswith(".ogg"):
+            if file.endswith(".ogg") or file.endswith(".ogg.part"):
                 file_path = os.path.join(t_path, file)
                 os.remove(file_path)
+        write_stored_data(t_path, stored_data)
 
     need_download = []
+    download_data = {}
 
     for theme in series_json["animethemes"]:
         audio_version = 1
@@ -187,51 +625,98 @@ def download_themes(t_path, args, series_json):
             for video in version["videos"]:
                 if video["overlap"] != "None": # No overs or transitions
                     continue
+                store_key = get_store_key(video["audio"]["link"], video["audio"]["updated_at"])
                 try: # Look to see if it is in data.json or needs an update
                     if video["audio"]["updated_at"] == stored_data[full_cur_theme]["updated_at"] and \
                         video["audio"]["link"] not in audio_links and \
                         os.path.isfile(os.path.join(t_path, full_cur_theme + ".ogg")):
                             audio_links.append(video["audio"]["link"])
-                            print(f"{full_cur_theme}: Found in directory", file=sys.stderr)
+                            print_line(f"{full_cur_theme}: Found in directory")
+                            # Also adds themes downloaded before there was a theme store
+                            store_theme(args, store_key, os.path.join(t_path, full_cur_theme + ".ogg"))
+                            stored_data[full_cur_theme]["store_key"] = store_key
+                            if theme_ready is not None:
+                                theme_ready(full_cur_theme)
                             audio_version += 1
                             break
                 except Exception:
                     pass
-                # Add to data.json
-                stored_data[full_cur_theme] = {}
-                stored_data[full_cur_theme]["updated_at"] = video["audio"]["updated_at"]
-                stored_data[full_cur_theme]["animethemes_filename"] = video["audio"]["filename"]
+                # Add to data.json, themes that need downloading only once they're downloaded
+                theme_data = {}
+                theme_data["updated_at"] = video["audio"]["updated_at"]
+                theme_data["animethemes_filename"] = video["audio"]["filename"]
+                theme_data["store_key"] = store_key
                 if video["audio"]["link"] not in audio_links:
-                    need_download.append((full_cur_theme, video["audio"]["link"]))
+                    if link_stored_theme(args, store_key, t_path, full_cur_theme):
+                        # Written before the theme gets matched so it is cached under the right version
+                        stored_data[full_cur_theme] = theme_data
+                        write_stored_data(t_path, stored_data)
+                        print_line(f"{full_cur_theme}: Found in theme store")
+                        if theme_ready is not None:
+                            theme_ready(full_cur_theme)
+                    else:
+                        remove_cached_theme(t_path, full_cur_theme)
+                        download_data[full_cur_theme] = theme_data
+                        version_key = hashlib.sha1(f'{theme_data["updated_at"]}|{theme_data["animethemes_filename"]}'.encode()).hexdigest()[:8]
+                        need_download.append((full_cur_theme, video["audio"]["link"], version_key))
                     audio_links.append(video["audio"]["link"])
                     audio_version += 1
+                else:
+                    stored_data[full_cur_theme] = theme_data
+
+    write_stored_data(t_path, stored_data)
 
     if len(need_download) > 0:
         print("Downloading themes...")
+        stats = {"bytes": 0, "lock": threading.Lock()}
+        downloaded = 0
+        start = time.time()
+        with get_download_session(args) as session, ThreadPoolExecutor(max_workers=args.parallel_dl) as executor:
+            future_to_url = {executor.submit(download_theme, session, t_path, theme, url, version_key, stats): (theme, url) for (theme, url, version_key) in need_download}
+            for future in as_completed(future_to_url):
+                (theme, url) = future_to_url[future]
+                try:
+                    if not future.result():
+                        continue
+                except Exception as exc:
+                    print_line(f"{url} generated an exception: {exc}")
+                    continue
+                # Written before the theme gets matched so it is cached under the right version
+                downloaded += 1
+                store_theme(args, download_data[theme]["store_key"], os.path.join(t_path, theme + ".ogg"))
+                stored_data[theme] = download_data[theme]
+                write_stored_data(t_path, stored_data)
+                if theme_ready is not None:
+                    theme_ready(theme)
+        elapsed = max(time.time() - start, 1e-6)
+        megabytes = stats["bytes"] / 1e6
+        print(f"Downloaded {downloaded}/{len(need_download)} themes, {megabytes:.1f} MB in {elapsed:.1f}s ({megabytes / elapsed:.2f} MB/s)", file=sys.stderr)
+
+    write_store_manifest(args, series_json, stored_data)
+    evicted, freed = evict_theme_store(args, keep={theme_data["store_key"] for theme_data in stored_data.values()
+                                                   if isinstance(theme_data, dict) and "store_key" in theme_data})
+    if evicted > 0:
+        print(f"Removed {evicted} least recently used themes from the theme store, freed {freed / 1e6:.1f} MB", file=sys.stderr)
+
+def get_chart_envelope(c, samplerate, start_time):
+    # Min and max of each bin keeps every peak visible while only a few thousand points get plotted
+    bin_size = max(math.ceil(len(c) / CHART_POINTS), 1)
+    bins = math.ceil(len(c) / bin_size)
+    binned = np.pad(c, (0, bins * bin_size - len(c)), mode="edge").reshape(bins, bin_size)
+    time_sec = start_time + np.arange(bins) * bin_size / samplerate
+    return time_sec, binned.min(axis=1), binned.max(axis=1)
+
+def generate_chart(theme_name, time_sec, c_min, c_max, charts_path, required_score, matched_time):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
 
-    with ThreadPoolExecutor(max_workers=args.parallel_dl) as executor:
-        future_to_url = {executor.submit(download_theme, t_path, theme, url): (theme, url) for (theme, url) in need_download}
-        for future in as_completed(future_to_url):
-            url = future_to_url[future]
-            try:
-                data = future.result()
-            except Exception as exc:
-                print(f"{url} generated an exception: {exc}", file=sys.stderr)
-
-    with open(os.path.join(t_path, "data.json"), "w") as outfile:
-        json.dump(stored_data, outfile, indent=4)
-
-def generate_chart(theme_name, c, t_path, required_score, samplerate, matched_time):
     try:
-        # Convert sample indices to seconds
-        time_sec = np.arange(len(c)) / samplerate
-
         # Create the figure and plot
         fig, ax = plt.subplots()
-        ax.plot(time_sec, c, label="Match score")
+        ax.fill_between(time_sec, c_min, c_max, linewidth=0.5, label="Match score")
 
         # Add horizontal dotted line
-        ax.axhline(y=required_score, color='red', linestyle=':', linewidth=1.5, label="Required Score (Scaled by Downsample)")
+        ax.axhline(y=required_score, color='red', linestyle=':', linewidth=1.5, label="Required Score")
 
         # Format x-axis as mm:ss
         def format_seconds(x, pos):
@@ -255,61 +740,500 @@ def generate_chart(theme_name, c, t_path, required_score, samplerate, matched_ti
 
     try:
         if matched_time is not None:
-            fig.savefig(os.path.join(f"{t_path}", "charts", f"{theme_name}_matched.png"))
+            fig.savefig(os.path.join(charts_path, f"{theme_name}_matched.png"))
         else:
-            fig.savefig(os.path.join(f"{t_path}", "charts", f"{theme_name}.png"))
+            fig.savefig(os.path.join(charts_path, f"{theme_name}.png"))
     except Exception as exc:
         print(f"{theme_name}: Could not save figure - {exc}", file=sys.stderr)
         return
+    finally:
+        plt.close(fig)
 
     print(f"{theme_name}: Chart generated")
 
-def find_offset(y_episode, sr_episode, theme_file, t_path, args):
+def get_chart_executor():
+    # One renderer process for the whole run instead of a new one for every theme
+    global chart_executor
+    with chart_lock:
+        if chart_executor is None:
+            chart_executor = ProcessPoolExecutor(max_workers=1)
+            # The process only starts with the first task, which is started here so it happens right away
+            chart_executor.submit(int)
+        return chart_executor
+
+def start_charts(args):
+    # Called before any other threads start so the renderer isn't forked from a process while they hold locks
+    if args.charts and not args.chart_data:
+        get_chart_executor()
+
+def finish_charts():
+    global chart_executor
+    with chart_lock:
+        if chart_executor is not None:
+            chart_executor.shutdown(wait=True)
+            chart_executor = None
+
+def queue_chart(theme_name, c, samplerate, start_time, required_score, matched_time, args):
+    time_sec, c_min, c_max = get_chart_envelope(c, samplerate, start_time)
+    queue_chart_envelope(theme_name, time_sec, c_min, c_max, required_score, matched_time, args)
+
+def queue_chart_envelope(theme_name, time_sec, c_min, c_max, required_score, matched_time, args):
+    # Match worker processes hand their charts back to the main process to draw
+    if worker_charts is not None:
+        worker_charts.append((theme_name, time_sec, c_min, c_max, required_score, matched_time))
+        return
+
+    if args.chart_data:
+        try:
+            np.savez(os.path.join(args.charts_path, f"{theme_name}.npz"), time_sec=time_sec, c_min=c_min, c_max=c_max,
+                     required_score=required_score, matched_time=matched_time if matched_time is not None else "")
+        except Exception as exc:
+            print(f"{theme_name}: Could not save chart data - {exc}", file=sys.stderr)
+        return
+
+    get_chart_executor().submit(generate_chart, theme_name, time_sec, c_min, c_max, args.charts_path, required_score, matched_time)
+
+def render_charts(charts_path):
+    for data_path in sorted(Path(charts_path).rglob("*.npz")):
+        with np.load(data_path) as data:
+            generate_chart(data_path.stem, data["time_sec"], data["c_min"], data["c_max"], data_path.parent,
+                           float(data["required_score"]), str(data["matched_time"]) or None)
+
+# Background chart renderer shared by every theme
+chart_executor = None
+chart_lock = threading.Lock()
+
+# Held while a theme claims the match for its type
+match_lock = threading.Lock()
+
+# Themes already decoded by this process, shared with batch workers
+loaded_themes = {}
+
+# Set in match worker processes, the episode attached from shared memory and what each task has to send back
+worker_episode = None
+worker_windows = {}
+worker_events = None
+worker_charts = None
+worker_memory = []
+
+def get_theme_cache_path(t_path, theme_file, sr, args, stored_data=None):
     theme_name = os.path.splitext(theme_file.name)[0]
+    if stored_data is None:
+        stored_data = read_stored_data(t_path)
+    stored_theme = stored_data.get(theme_name)
+    if stored_theme is not None:
+        source_key = f'{stored_theme["updated_at"]}|{stored_theme["animethemes_filename"]}'
+    else: # Theme added manually so use the file itself
+        stat = os.stat(theme_file)
+        source_key = f"{stat.st_mtime_ns}|{stat.st_size}"
+    key = hashlib.sha1(f"{source_key}|{sr}|{get_match_rate(sr, args)}".encode()).hexdigest()[:16]
+    return os.path.join(t_path, "cache", f"{theme_name}_{key}.npy")
+
+def remove_cached_theme(t_path, theme_name):
+    try:
+        cache_files = os.listdir(os.path.join(t_path, "cache"))
+    except OSError:
+        return
+    for file in cache_files:
+        if file.rsplit("_", 1)[0] == theme_name:
+            # Windows can't delete a file that is still memory mapped
+            loaded_themes.pop(os.path.join(t_path, "cache", file), None)
+            os.remove(os.path.join(t_path, "cache", file))
+
+def load_theme(theme_file, sr, t_path, args, cache_path=None):
+    # Decoded themes are cached already mono and downsampled so they can be memory mapped on later runs
+    if cache_path is None:
+        cache_path = get_theme_cache_path(t_path, theme_file, sr, args)
+    if cache_path in loaded_themes:
+        return loaded_themes[cache_path]
+    try:
+        loaded_themes[cache_path] = np.load(cache_path, mmap_mode="r")
+        return loaded_themes[cache_path]
+    except Exception:
+        pass
+
+    y_theme = decode_audio(theme_file, get_match_rate(sr, args))
+
+    # Filtering out everything above the matching rate loses energy that plain downsampling used to keep,
+    # so scale it back up to keep scores in line with the old ones
+    theme_energy = np.mean(np.square(decode_audio(theme_file, sr)), dtype=np.float64)
+    filtered_energy = np.mean(np.square(y_theme), dtype=np.float64)
+    if filtered_energy > 0:
+        y_theme *= theme_energy / filtered_energy
 
     try:
-        aro = audioread.ffdec.FFmpegAudioFile(str(theme_file))
-        y_theme, _ = librosa.load(aro, sr=sr_episode)
+        temp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as file:
+            np.save(file, y_theme)
+        os.replace(temp_path, cache_path)
     except Exception as exc:
-        print(f"{theme_name}: Could not load theme file - {exc}", file=sys.stderr)
-        sys.exit(1)
+        print_line(f"{os.path.splitext(theme_file.name)[0]}: Could not cache theme - {exc}")
+
+    loaded_themes[cache_path] = y_theme
+    return y_theme
+
+def get_cumulative_energy(y):
+    # Energy of any stretch of y is the difference of two of these, float64 so long episodes don't lose precision
+    energy = np.empty(len(y) + 1)
+    energy[0] = 0
+    np.cumsum(np.square(y, dtype=np.float64), out=energy[1:])
+    return energy
+
+def normalize_correlation(c, energy, y_theme):
+    # Divides every lag by the energy of the theme and of the episode under it so a perfect match is 1 however
+    # loud either is. The episode energy for all lags comes from the cumulative sum in one go
+    theme_norm = np.sqrt(np.dot(y_theme, y_theme.astype(np.float64)))
+    window_energy = energy[len(y_theme):len(y_theme) + len(c)] - energy[:len(c)]
+    # Silence would divide by zero, anything this quiet compared to the whole search can't be a match anyway
+    window_energy = np.maximum(window_energy, energy[-1] * 1e-9 + 1e-20)
+    return np.clip(c / (theme_norm * np.sqrt(window_energy)), -1, 1).astype(np.float32)
+
+class EpisodeSpectrum(object):
+    # The episode side of the correlation is the same for every theme so it only gets transformed once
+    def __init__(self, y, samplerate, coarse_factor=1, offset=0, workers=1, normalize=False):
+        # y already has the silence prepended, offset is where it starts in the full episode for search windows
+        self.samplerate = samplerate
+        self.silence_length = int(5 * samplerate)
+        self.y = y
+        self.offset = offset
+        self.coarse_factor = coarse_factor
+        self.workers = workers
+        self.normalize = normalize
+        self.search_y = None
+        self.spectrum = None
+        self.energy = None
+        self.lock = threading.Lock()
+
+    def window(self, start, stop):
+        start = max(start, 0)
+        return EpisodeSpectrum(self.y[start:stop], self.samplerate, self.coarse_factor, self.offset + start, self.workers, self.normalize)
+
+    def get_spectrum(self):
+        from scipy import signal, fft
+
+        # Only transformed when first needed so unused search windows cost nothing
+        with self.lock:
+            if self.spectrum is None:
+                # The whole episode is only searched at the coarse rate, filtered so it doesn't alias
+                if self.coarse_factor > 1:
+                    self.search_y = signal.resample_poly(self.y, 1, self.coarse_factor).astype(self.y.dtype)
+                else:
+                    self.search_y = self.y
+
+                # Lengths of at least the episode can't wrap around for any valid lag
+                self.fft_length = fft.next_fast_len(len(self.search_y), real=True)
+                self.spectrum = fft.rfft(self.search_y, self.fft_length, workers=self.workers)
+                if self.normalize:
+                    self.energy = get_cumulative_energy(self.search_y)
+        return self.spectrum
+
+    def correlate(self, y_theme):
+        from scipy import fft
+
+        spectrum = self.get_spectrum()
+        theme_spectrum = fft.rfft(y_theme, self.fft_length, workers=self.workers)
+        c = fft.irfft(spectrum * np.conj(theme_spectrum), self.fft_length, workers=self.workers)
+        c = c[:len(self.search_y) - len(y_theme) + 1]
+        if self.normalize:
+            return normalize_correlation(c, self.energy, y_theme)
+        return c
+
+    def correlate_segment(self, y_segment, y_theme):
+        from scipy import fft
+
+        fft_length = fft.next_fast_len(len(y_segment), real=True)
+        segment_spectrum = fft.rfft(y_segment, fft_length, workers=self.workers)
+        theme_spectrum = fft.rfft(y_theme, fft_length, workers=self.workers)
+        c = fft.irfft(segment_spectrum * np.conj(theme_spectrum), fft_length, workers=self.workers)
+        c = c[:len(y_segment) - len(y_theme) + 1]
+        if self.normalize:
+            return normalize_correlation(c, get_cumulative_energy(y_segment), y_theme)
+        return c
+
+    def refine(self, y_theme, lag):
+        # Only correlates lags within the refine window around the given one
+        window = int(REFINE_WINDOW * self.samplerate)
+        max_lag = len(self.y) - len(y_theme)
+        lag = min(max(lag - self.offset, 0), max_lag)
+        start = max(lag - window, 0)
+        stop = min(lag + window, max_lag) + 1
+        c = self.correlate_segment(self.y[start:stop + len(y_theme) - 1], y_theme)
+        match_idx = int(np.argmax(c))
+        return self.offset + start + match_idx, c[match_idx], c, self.samplerate, self.offset + start
+
+    def match(self, y_theme):
+        # Returns the best lag and score at the full matching rate along with the curve that was searched for charts
+        from scipy import signal
+
+        if len(y_theme) > len(self.y):
+            c = signal.correlate(self.y, y_theme, mode="valid", method="auto")
+            if self.normalize:
+                c = normalize_correlation(c, get_cumulative_energy(self.y), y_theme)
+            match_idx = int(np.argmax(c))
+            return self.offset + match_idx, c[match_idx], c, self.samplerate, self.offset
+
+        if self.coarse_factor == 1:
+            c = self.correlate(y_theme)
+            match_idx = int(np.argmax(c))
+            return self.offset + match_idx, c[match_idx], c, self.samplerate, self.offset
+
+        c = self.correlate(signal.resample_poly(y_theme, 1, self.coarse_factor))
+        peaks, _ = signal.find_peaks(c, distance=max(int(REFINE_WINDOW * self.samplerate / self.coarse_factor), 1))
+        candidates = set(peaks[np.argsort(c[peaks])[::-1][:COARSE_CANDIDATES]])
+        candidates.add(int(np.argmax(c)))
+
+        refined = [self.refine(y_theme, self.offset + int(coarse_idx) * self.coarse_factor) for coarse_idx in candidates]
+        match_idx, score, _, _, _ = max(refined, key=lambda result: result[1])
+        # Scale the coarse curve so it lines up with the required score in charts, confidences already do
+        if not self.normalize:
+            c = c * self.coarse_factor
+        return match_idx, score, c, self.samplerate / self.coarse_factor, self.offset
+
+def get_landmark_layout(samplerate):
+    # STFT window of about 0.1 secs and the bits each frequency takes in a hash, wide enough for every bin
+    # of that window so unrelated pairs never share a hash at high match rates
+    window = 2 ** int(round(math.log2(0.1 * samplerate)))
+    freq_bits = max((window // 2).bit_length(), 7)
+    return window, freq_bits
+
+def get_landmarks(y, samplerate):
+    from scipy import signal, ndimage
+
+    # Pairs of spectrogram peaks hashed by their frequencies and distance apart, anchored at the first peak's frame
+    window, freq_bits = get_landmark_layout(samplerate)
+    hop = window // 2
+    _, _, spectrogram = signal.stft(y, nperseg=window, noverlap=window - hop, boundary=None, padded=False)
+    spectrogram = np.log(np.abs(spectrogram) + 1e-6)
+    peaks = (spectrogram == ndimage.maximum_filter(spectrogram, size=(15, 15))) & (spectrogram > np.median(spectrogram))
+    times, freqs = np.nonzero(peaks.T)
+
+    hashes = []
+    anchor_times = []
+    for pair in range(1, FINGERPRINT_FAN_OUT + 1):
+        dt = times[pair:] - times[:-pair]
+        keep = (dt > 0) & (dt <= FINGERPRINT_MAX_DT)
+        hashes.append((freqs[:-pair][keep].astype(np.uint64) << np.uint64(freq_bits + 7)) | (freqs[pair:][keep].astype(np.uint64) << np.uint64(7)) | dt[keep].astype(np.uint64))
+        anchor_times.append(times[:-pair][keep])
+
+    return np.concatenate(hashes), np.concatenate(anchor_times).astype(np.int64), hop
+
+def load_fingerprint_index(t_path, theme_files, sr_episode, args):
+    # Inverted index of every theme's landmarks sorted by hash, rebuilt whenever a theme's cache key changes
+    theme_files = sorted(theme_files)
+    stored_data = read_stored_data(t_path)
+    cache_paths = [get_theme_cache_path(t_path, theme_path, sr_episode, args, stored_data) for (_, theme_path) in theme_files]
+    keys = [os.path.basename(cache_path) for cache_path in cache_paths]
+    index_path = os.path.join(t_path, "cache", "fingerprints.npz")
+    _, freq_bits = get_landmark_layout(get_match_rate(sr_episode, args))
+    try:
+        with np.load(index_path) as index:
+            if list(index["keys"]) == keys and int(index["freq_bits"]) == freq_bits:
+                return dict(index)
+    except Exception:
+        pass
 
-    y_episode= y_episode[::args.downsample]
-    y_theme = y_theme[::args.downsample]
+    print("Building fingerprint index...", end="", flush=True)
+    hashes = []
+    theme_ids = []
+    times = []
+    for (theme_id, ((_, theme_path), cache_path)) in enumerate(zip(theme_files, cache_paths)):
+        theme_hashes, theme_times, _ = get_landmarks(load_theme(theme_path, sr_episode, t_path, args, cache_path), get_match_rate(sr_episode, args))
+        hashes.append(theme_hashes)
+        theme_ids.append(np.full(len(theme_hashes), theme_id, dtype=np.int64))
+        times.append(theme_times)
+
+    hashes = np.concatenate(hashes)
+    order = np.argsort(hashes, kind="stable")
+    index = {"keys": np.array(keys), "names": np.array([theme_name for (theme_name, _) in theme_files]), "freq_bits": np.array(freq_bits),
+             "hashes": hashes[order], "theme_ids": np.concatenate(theme_ids)[order], "times": np.concatenate(times)[order]}
 
-    # 5 secs silence prepended to fix matches at the beginning of episode
-    silence_length = int(5 * sr_episode / args.downsample)
-    y_episode_adjust = np.empty(silence_length + len(y_episode), dtype=y_episode.dtype)
-    y_episode_adjust[:silence_length] = 0
-    y_episode_adjust[silence_length:] = y_episode
+    try:
+        temp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as file:
+            np.savez(file, **index)
+        os.replace(temp_path, index_path)
+    except Exception as exc:
+        print(f"\rCould not save fingerprint index - {exc}", file=sys.stderr)
+
+    print("\rBuilt fingerprint index      ")
+    return index
+
+def query_fingerprints(index, episode):
+    # Every landmark shared with a theme votes for that theme starting at the difference in their frames
+    episode_hashes, episode_times, hop = get_landmarks(episode.y, episode.samplerate)
+    left = np.searchsorted(index["hashes"], episode_hashes, side="left")
+    counts = np.searchsorted(index["hashes"], episode_hashes, side="right") - left
+    positions = np.repeat(left, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+    theme_ids = index["theme_ids"][positions]
+    frame_offsets = np.repeat(episode_times, counts) - index["times"][positions]
+    if len(frame_offsets) == 0:
+        return {}
+
+    min_offset = frame_offsets.min()
+    span = frame_offsets.max() - min_offset + 1
+    pairs, votes = np.unique(theme_ids * span + (frame_offsets - min_offset), return_counts=True)
+    pair_themes = pairs // span
+
+    # Sorted by theme then votes so the last pair of each theme is its best offset
+    order = np.lexsort((votes, pair_themes))
+    best_pairs = order[np.append(pair_themes[order][1:] != pair_themes[order][:-1], True)]
+
+    candidates = {}
+    for pair in best_pairs:
+        if votes[pair] >= FINGERPRINT_MIN_VOTES:
+            frame_offset = pairs[pair] % span + min_offset
+            candidates[str(index["names"][pair_themes[pair]])] = (int(votes[pair]), int(frame_offset) * hop)
+
+    return candidates
+
+def is_cancelled(theme_name, cancelled):
+    if cancelled is not None and cancelled.is_set():
+        print_line(f"{theme_name}: Skipping because already matched an {'OP' if 'OP' in theme_name else 'ED'}")
+        return True
+    return False
 
-    duration = librosa.get_duration(path=str(theme_file))
-    y_theme_first_portion = y_theme[:int(sr_episode * ((duration + 5) * args.theme_portion) / args.downsample)]
+def claim_match(theme_name, cancelled):
+    # Only the first theme of a type to match keeps it when they are matched in parallel
+    if cancelled is None:
+        return True
+    with match_lock:
+        if is_cancelled(theme_name, cancelled):
+            return False
+        cancelled.set()
+        return True
 
+def get_match_cache_path(t_path, episode):
+    # Keyed on the decoded episode audio so a remux or rename still finds it but a different cut doesn't
+    return os.path.join(t_path, "matches", hashlib.sha1(episode.y).hexdigest()[:16] + ".json")
+
+def read_match_cache(t_path, episode, args):
+    if args.no_match_cache:
+        return None
     try:
-        c = signal.correlate(y_episode_adjust, y_theme_first_portion, mode="valid", method="auto")
-    except Exception as exc:
-        print(f"{theme_name}: Error in correlate - {exc}", file=sys.stderr)
+        with open(get_match_cache_path(t_path, episode)) as data:
+            return json.load(data)
+    except Exception:
+        return {}
+
+def write_match_cache(t_path, episode, match_cache):
+    try:
+        cache_path = get_match_cache_path(t_path, episode)
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as outfile:
+            json.dump(match_cache, outfile)
+        os.replace(tmp_path, cache_path)
+    except OSError as exc:
+        print(f"Could not save match results - {exc}", file=sys.stderr)
+
+def get_required_score(args):
+    # Raw correlation grows with the number of samples so --score is scaled by the downsample factor
+    if args.normalize:
+        return args.confidence
+    return args.score / args.downsample
+
+def format_score(score, args):
+    # In the same units as --confidence or --score so they can be tuned from the output without charts
+    if args.normalize:
+        return f"confidence {score:.2f}"
+    return f"score {round(score * args.downsample)}"
+
+def get_match_key(theme_cache_path, episode, lag_hint, args):
+    # Everything that changes the correlation, the theme cache name already has its version and the matching rate.
+    # Thresholds like --score aren't part of it so they get applied to the cached score again
+    theme_key = os.path.basename(theme_cache_path)
+    match_key = f"{theme_key}|{args.theme_portion}|{episode.coarse_factor}|{episode.offset}:{len(episode.y)}|{lag_hint}"
+    if args.normalize:
+        match_key += "|normalized"
+    return match_key
+
+def get_top_peaks(c, c_samplerate, c_start, samplerate):
+    # Best lags other than the match, kept for looking into near misses without correlating again
+    from scipy import signal
+
+    peaks, _ = signal.find_peaks(c, distance=max(int(REFINE_WINDOW * c_samplerate), 1))
+    if len(peaks) == 0:
+        peaks = np.array([int(np.argmax(c))])
+    peaks = peaks[np.argsort(c[peaks])[::-1][:MATCH_CACHE_PEAKS]]
+    return [[c_start + int(round(peak * samplerate / c_samplerate)), float(c[peak])] for peak in peaks]
+
+def find_offset(episode, sr_episode, theme_file, t_path, args, lag_hint=None, cancelled=None, match_cache=None, lag_range=None):
+    theme_name = os.path.splitext(theme_file.name)[0]
+    if is_cancelled(theme_name, cancelled):
         return None, None
 
-    required_score = args.score / args.downsample
+    # The theme's version is only looked up once, data.json can change while downloads are still going
+    try:
+        theme_cache_path = get_theme_cache_path(t_path, theme_file, sr_episode, args)
+    except Exception as exc:
+        print_line(f"{theme_name}: Could not load theme file - {exc}")
+        sys.exit(1)
+
+    # Charts need the whole correlation curve so they always correlate
+    match_key = None
+    cached = None
+    if match_cache is not None:
+        match_key = get_match_key(theme_cache_path, episode, lag_hint, args)
+        if not args.charts:
+            cached = match_cache.get(match_key)
+
+    silence_length = episode.silence_length
+
+    if cached is not None:
+        duration = cached["duration"]
+        match_idx = cached["match_idx"]
+        score = cached["score"]
+    else:
+        try:
+            y_theme = load_theme(theme_file, sr_episode, t_path, args, theme_cache_path)
+        except Exception as exc:
+            print_line(f"{theme_name}: Could not load theme file - {exc}")
+            sys.exit(1)
+
+        if is_cancelled(theme_name, cancelled):
+            return None, None
+
+        duration = len(y_theme) / episode.samplerate
+        y_theme_first_portion = y_theme[:int(episode.samplerate * ((duration + 5) * args.theme_portion))]
+
+        try:
+            if lag_hint is not None and len(y_theme_first_portion) <= len(episode.y):
+                match_idx, score, c, c_samplerate, c_start = episode.refine(y_theme_first_portion, lag_hint)
+            else:
+                match_idx, score, c, c_samplerate, c_start = episode.match(y_theme_first_portion)
+        except Exception as exc:
+            print_line(f"{theme_name}: Error in correlate - {exc}")
+            return None, None
+
+        if match_cache is not None:
+            match_cache[match_key] = {"duration": duration, "match_idx": int(match_idx), "score": float(score),
+                                      "peaks": get_top_peaks(c, c_samplerate, c_start, episode.samplerate)}
+
+    required_score = get_required_score(args)
 
-    match_idx = np.argmax(c)
-    score = np.max(c)
-    offset = max(round((match_idx - silence_length) / (sr_episode / args.downsample), 2), 0)
+    offset = max(round((match_idx - silence_length) / episode.samplerate, 2), 0)
 
-    if score > required_score:
-        print(f"{theme_name}: Matched from {get_timestamp(offset)} -> {get_timestamp(offset + duration)}", file=sys.stderr)
+    # A theme cut off at the edge of the search window isn't a match, the whole episode gets searched instead
+    in_range = lag_range is None or lag_range[0] <= match_idx <= lag_range[1]
+
+    if score > required_score and in_range:
+        if not claim_match(theme_name, cancelled):
+            return None, None
+        print_line(f"{theme_name}: Matched from {get_timestamp(offset)} -> {get_timestamp(offset + duration)} ({format_score(score, args)})")
         if args.charts:
-            with ProcessPoolExecutor() as executor:
-                executor.submit(generate_chart, theme_name, c, t_path, required_score, sr_episode / args.downsample, get_timestamp(offset))
+            queue_chart(theme_name, c, c_samplerate, c_start / episode.samplerate, required_score, get_timestamp(offset), args)
         return offset, (offset + duration)
 
     else:
-        print(f"{theme_name}: Not matched", file=sys.stderr)
+        if is_cancelled(theme_name, cancelled):
+            return None, None
+        if score > required_score:
+            print_line(f"{theme_name}: Not matched, best match at {get_timestamp(offset)} is outside the search window ({format_score(score, args)})")
+        else:
+            print_line(f"{theme_name}: Not matched ({format_score(score, args)})")
         if args.charts:
-            with ProcessPoolExecutor() as executor:
-                executor.submit(generate_chart, theme_name, c, t_path, required_score, sr_episode / args.downsample, None)
+            queue_chart(theme_name, c, c_samplerate, c_start / episode.samplerate, required_score, None, args)
         return None, None
 
 def get_timestamp(timesec):
@@ -394,92 +1318,460 @@ def validate_themes(args, t_path):
         valid = False
         if os.path.isdir(t_path):
             for theme_file in os.scandir(t_path):
-                if ".ogg" in str(theme_file):
+                if theme_file.name.endswith(".ogg"):
                     valid = True
         if not valid:
             print("No valid themes. Specify a search-name to download themes.", file=sys.stderr)
             sys.exit(1)
 
-def try_download(args, t_path):
+def try_download(args, t_path, theme_ready=None):
     if not args.no_download:
-        print("Searching AnimeThemes...", end="", flush=True)
+        print("Searching AnimeThemes...", flush=True)
         try:
-            series_json = get_series_json(args)
-            print(f'\rAnimeThemes matched series: {series_json["name"]}', file=sys.stderr)
+            series_json = get_series_json(args, t_path)
+            print(f'AnimeThemes matched series: {series_json["name"]}', file=sys.stderr)
             print_seperator()
-            download_themes(t_path, args, series_json)
+            download_themes(t_path, args, series_json, theme_ready)
             print_seperator()
         except Exception as exc:
-            print(f"\rCouldn't access api or download: {exc}", file=sys.stderr)
+            print(f"Couldn't access api or download: {exc}", file=sys.stderr)
 
-def extract_episode_audio(args):
-    file_path = args.input
+def fetch_themes(args, t_path, theme_events, download):
+    # Each theme is handed to the matcher as soon as it's ready instead of after every download finishes
+    ready = set()
+    def theme_ready(theme_name):
+        if theme_name not in ready:
+            ready.add(theme_name)
+            theme_events.put(("theme", theme_name))
 
-    extract_path = f"{str(file_path)}.autochap.wav"
     try:
-        os.remove(extract_path)
-    except OSError:
-        pass
+        if download:
+            try_download(args, t_path, theme_ready)
+        # Anything else in the folder, like themes added manually or when the api couldn't be reached
+        for theme_file in sorted(os.scandir(t_path), key=lambda theme_file: theme_file.name):
+            if theme_file.name.endswith(".ogg"):
+                theme_ready(os.path.splitext(theme_file.name)[0])
+    finally:
+        theme_events.put(("themes done", None))
 
-    if str(file_path).endswith(".mkv"):
-        print("Extracting episode audio...", end="", flush=True)
-        # Extract as a temp wav file
-        output = subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-n", "-i",
-                                 file_path, "-map", "0:a:0", extract_path], capture_output=True)
-        if len(output.stderr) > 0:
-            print("\rextraction error          ", file=sys.stderr)
-            print(output.stderr.decode())
-            sys.exit(1)
+def get_sample_rate(file_path):
+    with audioread.ffdec.FFmpegAudioFile(str(file_path)) as audio_file:
+        return audio_file.samplerate
+
+def get_match_rate(sr, args):
+    return max(round(sr / args.downsample), 1)
 
-        args.episode_audio_path = extract_path
-        print("\rExtracted episode audio      ")
+def decode_audio(file_path, sample_rate):
+    # Mono 16-bit PCM piped straight out of ffmpeg so nothing gets written to disk
+    output = subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", file_path, "-map", "0:a:0",
+                             "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "-"], capture_output=True)
+    if output.returncode != 0:
+        raise Exception(output.stderr.decode().strip())
+
+    y = np.frombuffer(output.stdout, dtype=np.int16).astype(np.float32)
+    y /= 32768
+    return y
+
+def extract_episode_audio(args):
+    # Runs while themes are being searched for and downloaded so it doesn't share a line with those messages
+    print("Extracting episode audio...", flush=True)
+    try:
+        # Decoded straight to the matching rate with ffmpeg filtering out anything that would alias
+        sr_episode = get_sample_rate(args.input)
+        y_episode = decode_audio(args.input, get_match_rate(sr_episode, args))
+    except Exception as exc:
+        print(f"Could not load input file - {str(args.input)}: {exc}", file=sys.stderr)
+        sys.exit(1)
+
+    print("Extracted episode audio", flush=True)
+    return y_episode, sr_episode
+
+def get_theme_searches(theme_files, episode, fingerprints, search_episode, lag_range):
+    # Rounds of (theme name, theme path, episode to search, lag hint, lags a match can start at) where later
+    # rounds only run if nothing matched
+    if fingerprints is not None:
+        # Only verify the themes with the most votes, best first
+        for (theme_name, _) in theme_files:
+            if theme_name not in fingerprints:
+                print_line(f"{theme_name}: Not matched by fingerprint")
+        theme_files = sorted((theme_file for theme_file in theme_files if theme_file[0] in fingerprints),
+                             key=lambda theme_file: fingerprints[theme_file[0]][0], reverse=True)[:FINGERPRINT_CANDIDATES]
+        return [[(theme_name, theme_path, episode, fingerprints[theme_name][1], None) for (theme_name, theme_path) in theme_files]]
+
+    rounds = [[(theme_name, theme_path, episode, None, None) for (theme_name, theme_path) in theme_files]]
+    # Search the window first and fall back to the whole episode if nothing matches in it
+    if search_episode is not None:
+        rounds.insert(0, [(theme_name, theme_path, search_episode, None, lag_range) for (theme_name, theme_path) in theme_files])
+    return rounds
+
+def get_theme_rounds(args, t_path, episode, sr_episode, theme_files):
+    op_files = theme_files["OP"]
+    ed_files = theme_files["ED"]
+
+    # Nothing to index without themes
+    fingerprints = None
+    if args.fingerprint and len(op_files + ed_files) > 0:
+        index = load_fingerprint_index(t_path, op_files + ed_files, sr_episode, args)
+        fingerprints = query_fingerprints(index, episode)
+
+    op_episode = None
+    ed_episode = None
+    op_range = None
+    ed_range = None
+    if args.search_window is not None and not args.fingerprint:
+        # OPs have to start in the leading window and EDs in the trailing one, with room for the longest theme after
+        window = int(args.search_window * (len(episode.y) - episode.silence_length))
+        longest_theme = max((len(load_theme(theme_path, sr_episode, t_path, args)) for (_, theme_path) in op_files + ed_files), default=0)
+        op_episode = episode.window(0, episode.silence_length + window + longest_theme)
+        ed_episode = episode.window(min(len(episode.y) - window, len(episode.y) - longest_theme), len(episode.y))
+        # The windows have room for the themes so they also have lags outside the window that can't be matched
+        op_range = (0, episode.silence_length + window)
+        ed_range = (len(episode.y) - window, len(episode.y))
+
+    return {"OP": get_theme_searches(op_files, episode, fingerprints, op_episode, op_range),
+            "ED": get_theme_searches(ed_files, episode, fingerprints, ed_episode, ed_range)}
+
+def share_episode(episode):
+    # The episode and its spectrum are copied into shared memory once and workers only get their names
+    from multiprocessing import shared_memory
+
+    episode.get_spectrum()
+    blocks = []
+    arrays = {}
+    for (name, array) in (("y", episode.y), ("search_y", episode.search_y), ("spectrum", episode.spectrum), ("energy", episode.energy)):
+        if array is None:
+            continue
+        if name == "search_y" and array is episode.y:
+            arrays[name] = arrays["y"]
+            continue
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        blocks.append(block)
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+        arrays[name] = (block.name, array.shape, array.dtype.str)
+    episode_info = {"arrays": arrays, "samplerate": episode.samplerate, "coarse_factor": episode.coarse_factor,
+                    "workers": episode.workers, "fft_length": episode.fft_length, "normalize": episode.normalize}
+    return blocks, episode_info
+
+def free_episode(blocks):
+    for block in blocks:
+        block.close()
+        block.unlink()
+
+def init_match_worker(episode_info, lock, events):
+    from multiprocessing import shared_memory
+
+    global worker_episode, worker_events, match_lock
+    arrays = {}
+    for (name, (block_name, shape, dtype)) in episode_info["arrays"].items():
+        block = shared_memory.SharedMemory(name=block_name)
+        worker_memory.append(block) # Has to stay open for as long as the arrays are used
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    worker_episode = EpisodeSpectrum(arrays["y"], episode_info["samplerate"], episode_info["coarse_factor"],
+                                     workers=episode_info["workers"], normalize=episode_info["normalize"])
+    worker_episode.search_y = arrays["search_y"]
+    worker_episode.spectrum = arrays["spectrum"]
+    worker_episode.energy = arrays.get("energy")
+    worker_episode.fft_length = episode_info["fft_length"]
+    # Claiming a match has to be seen by every process
+    match_lock = lock
+    worker_events = events
+
+def find_offset_worker(window, sr_episode, theme_file, t_path, args, lag_hint, lag_range, theme_type, match_cache):
+    global worker_charts
+
+    # Search windows are cut from the shared episode the first time a worker needs them
+    if window is None:
+        search_episode = worker_episode
     else:
-        args.episode_audio_path = str(args.input)
+        if window not in worker_windows:
+            worker_windows[window] = worker_episode.window(*window)
+        search_episode = worker_windows[window]
+
+    worker_charts = []
+    cached_keys = set(match_cache) if match_cache is not None else set()
+    offset1, offset2 = find_offset(search_episode, sr_episode, theme_file, t_path, args, lag_hint, worker_events[theme_type], match_cache, lag_range)
+    new_results = {key: result for (key, result) in match_cache.items() if key not in cached_keys} if match_cache is not None else {}
+    return offset1, offset2, new_results, worker_charts
+
+def get_match_executor(args, episode, cancelled):
+    if args.match_backend == "threads":
+        return ThreadPoolExecutor(max_workers=args.jobs), []
+    import multiprocessing
+
+    blocks, episode_info = share_episode(episode)
+    executor = ProcessPoolExecutor(max_workers=args.jobs, initializer=init_match_worker,
+                                   initargs=(episode_info, multiprocessing.Lock(), cancelled))
+    return executor, blocks
+
+def match_themes(args, t_path, episode, sr_episode, theme_events):
+    # Fingerprints and search windows need every theme up front, otherwise themes get matched as they arrive
+    streaming = args.search_window is None and not args.fingerprint
+    theme_files = {"OP": [], "ED": []}
+    theme_rounds = {"OP": [], "ED": []}
+    if args.match_backend == "processes":
+        import multiprocessing
+        cancelled = {"OP": multiprocessing.Event(), "ED": multiprocessing.Event()}
+    else:
+        cancelled = {"OP": threading.Event(), "ED": threading.Event()}
 
-def process_themes(t_path, args, theme_files, theme_type, y_episode, sr_episode):
-        matched_flag = False
-        local_offset_list = []
-        for (theme_name, theme_path) in theme_files:
-            if theme_type in theme_name and matched_flag:
-                print(f"{theme_name}: Skipping because already matched an {theme_type}", file=sys.stderr)
-                continue
-            offset1, offset2 = find_offset(y_episode, sr_episode, theme_path, t_path, args)
-            if offset1 is not None:
-                matched_flag = True
-                local_offset_list.append(offset1)
-                local_offset_list.append(offset2)
-
-        return local_offset_list
-
-def match_themes(args, t_path):
-    op_files = []
-    ed_files = []
-    for theme_file in os.scandir(t_path):
-        if ".ogg" in str(theme_file):
-            theme_name = os.path.splitext(Path(theme_file.path).name)[0]
-            theme_path = Path(theme_file.path)
-            if "OP" in theme_name:
-                op_files.append((theme_name, theme_path))
-            elif "ED" in theme_name:
-                ed_files.append((theme_name, theme_path))
-
-    offset_list = []
+    matches = []
+    match_cache = read_match_cache(t_path, episode, args)
     print("Matching themes...")
 
+    def worker_done(future):
+        # Results and charts from worker processes get merged back in before the match is looked at
+        if not future.cancelled() and future.exception() is None:
+            (_, _, new_results, charts) = future.result()
+            if match_cache is not None:
+                match_cache.update(new_results)
+            for chart in charts:
+                queue_chart_envelope(*chart, args)
+        theme_events.put(("finished", future))
+
+    # Every theme is its own task with the OPs and EDs interleaved so both types make progress
+    executor, shared_blocks = get_match_executor(args, episode, cancelled)
+    # Shared memory stays around until it's unlinked so it has to be freed even when matching fails
+    try:
+        with executor:
+            pending = {}
+
+            def submit(theme_type, search):
+                (theme_name, theme_path, search_episode, lag_hint, lag_range) = search
+                if args.match_backend == "processes":
+                    window = None if search_episode is episode else (search_episode.offset, search_episode.offset + len(search_episode.y))
+                    future = executor.submit(find_offset_worker, window, sr_episode, theme_path, t_path, args, lag_hint, lag_range, theme_type, match_cache)
+                    pending[future] = (theme_type, theme_name)
+                    future.add_done_callback(worker_done)
+                else:
+                    future = executor.submit(find_offset, search_episode, sr_episode, theme_path, t_path, args, lag_hint, cancelled[theme_type], match_cache, lag_range)
+                    pending[future] = (theme_type, theme_name)
+                    future.add_done_callback(lambda future: theme_events.put(("finished", future)))
+
+            def submit_round(theme_types):
+                type_searches = [[(theme_type, search) for search in theme_rounds[theme_type].pop(0)] for theme_type in theme_types]
+                searches = [search for search in itertools.chain.from_iterable(itertools.zip_longest(*type_searches)) if search is not None]
+                for (theme_type, search) in searches:
+                    submit(theme_type, search)
+
+            # New themes and finished matches both come through the same queue
+            themes_done = False
+            while not themes_done or len(pending) > 0:
+                (event, value) = theme_events.get()
+                if event == "theme":
+                    theme_type = "OP" if "OP" in value else "ED" if "ED" in value else None
+                    if theme_type is None:
+                        continue
+                    theme_path = Path(t_path) / (value + ".ogg")
+                    theme_files[theme_type].append((value, theme_path))
+                    if streaming:
+                        submit(theme_type, (value, theme_path, episode, None, None))
+
+                elif event == "themes done":
+                    themes_done = True
+                    if not streaming:
+                        theme_rounds = get_theme_rounds(args, t_path, episode, sr_episode, theme_files)
+                        submit_round([theme_type for theme_type in theme_rounds if len(theme_rounds[theme_type]) > 0])
+
+                else:
+                    future = value
+                    (theme_type, theme_name) = pending.pop(future)
+                    if future.cancelled():
+                        continue
+
+                    offset1, offset2 = future.result()[:2]
+                    if offset1 is not None:
+                        matches.append((theme_name, offset1, offset2))
+                        for (other_future, (other_type, other_name)) in pending.items():
+                            if other_type == theme_type and other_future.cancel():
+                                print_line(f"{other_name}: Skipping because already matched an {theme_type}")
+
+                    type_pending = any(other_type == theme_type for (other_type, _) in pending.values())
+                    if not type_pending and not cancelled[theme_type].is_set() and len(theme_rounds[theme_type]) > 0:
+                        print_line(f"No {theme_type} matched in the search window. Searching the whole episode...")
+                        submit_round([theme_type])
+    finally:
+        free_episode(shared_blocks)
+
+    if match_cache is not None:
+        write_match_cache(t_path, episode, match_cache)
+    return matches
+
+def stream_audio(file_path, sample_rate, block_length):
+    # Same as decode_audio but handed over a block at a time so the whole episode is never in memory
+    process = subprocess.Popen(["ffmpeg", "-hide_banner", "-loglevel", "error", "-i", file_path, "-map", "0:a:0",
+                                "-ac", "1", "-ar", str(sample_rate), "-f", "s16le", "-"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = process.stdout.read(block_length * 2)
+            if len(data) == 0:
+                break
+            y = np.frombuffer(data[:len(data) // 2 * 2], dtype=np.int16).astype(np.float32)
+            y /= 32768
+            yield y
+        if process.wait() != 0:
+            raise Exception(process.stderr.read().decode().strip())
+    finally:
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+        process.stdout.close()
+        process.stderr.close()
+
+def get_block_fft_length(args, theme_lengths, expected_length):
+    # Per sample of FFT length every theme keeps a spectrum, the episode needs about 5 copies between the
+    # pending audio, the block and its spectrum and every job needs a product and a correlation
+    budget = args.max_memory * 1e6 - sum(theme_lengths) * 4
+    bytes_per_sample = 4 * len(theme_lengths) + 20 + 8 * args.jobs
+    fft_length = 1 << max(int(budget / bytes_per_sample), 1).bit_length() - 1
+    # Blocks bigger than the whole episode only add padding
+    fft_length = min(fft_length, 1 << (expected_length + 2 * max(theme_lengths)).bit_length())
+    if fft_length < 2 * max(theme_lengths):
+        needed = (sum(theme_lengths) * 4 + (1 << (2 * max(theme_lengths) - 1).bit_length()) * bytes_per_sample) / 1e6
+        print(f"Max memory of {args.max_memory:g} MB is too small for these themes, needs at least {math.ceil(needed)} MB", file=sys.stderr)
+        sys.exit(1)
+    return fft_length
+
+def update_top_peaks(peaks, c, lag_start, min_distance):
+    # The block's best lag is always a candidate so a peak right at the edge of a block isn't missed
+    from scipy import signal
+
+    candidates, _ = signal.find_peaks(c, distance=min_distance)
+    candidates = np.append(candidates[np.argsort(c[candidates])[::-1][:MATCH_CACHE_PEAKS]], np.argmax(c))
+    peaks = peaks + [(lag_start + int(candidate), float(c[candidate])) for candidate in candidates]
+    top_peaks = []
+    for (lag, score) in sorted(peaks, key=lambda peak: peak[1], reverse=True):
+        if all(abs(lag - top_lag) >= min_distance for (top_lag, _) in top_peaks):
+            top_peaks.append((lag, score))
+            if len(top_peaks) == MATCH_CACHE_PEAKS:
+                break
+    return top_peaks
+
+def update_envelope(envelope, c, lag_start, bin_size):
+    # Min and max of every chart bin the block covers, bins split across blocks get combined
+    starts = np.unique(np.concatenate(([0], np.arange((-lag_start) % bin_size, len(c), bin_size))))
+    bins = (lag_start + starts) // bin_size
+    if bins[-1] >= len(envelope[0]):
+        extra = bins[-1] + 1 - len(envelope[0])
+        envelope[0] = np.append(envelope[0], np.full(extra, np.inf, dtype=np.float32))
+        envelope[1] = np.append(envelope[1], np.full(extra, -np.inf, dtype=np.float32))
+    envelope[0][bins] = np.minimum(envelope[0][bins], np.minimum.reduceat(c, starts))
+    envelope[1][bins] = np.maximum(envelope[1][bins], np.maximum.reduceat(c, starts))
+
+def correlate_blocks(args, sr_episode, themes, expected_length):
+    # Overlap-save correlation, every segment is the last longest theme - 1 samples of the one before it plus
+    # a new block so each lag only gets correlated once and never needs audio from outside its segment
+    from scipy import fft
+
+    match_rate = get_match_rate(sr_episode, args)
+    theme_lengths = [len(y_theme) for (_, y_theme, _) in themes]
+    longest_theme = max(theme_lengths)
+    fft_length = get_block_fft_length(args, theme_lengths, expected_length)
+    block_length = fft_length - longest_theme + 1
+    theme_spectra = [np.conj(fft.rfft(y_theme, fft_length)) for (_, y_theme, _) in themes]
+    min_distance = max(int(REFINE_WINDOW * match_rate), 1)
+    bin_size = max(math.ceil(expected_length / CHART_POINTS), 1)
+
+    peaks = [[] for _ in themes]
+    envelopes = [[np.full(0, np.inf, dtype=np.float32), np.full(0, -np.inf, dtype=np.float32)] for _ in themes]
+
+    def correlate_theme(theme_number, segment_spectrum, segment_energy, segment_length, lag_start):
+        lags = min(block_length, segment_length - theme_lengths[theme_number] + 1)
+        if lags <= 0:
+            return
+        c = fft.irfft(segment_spectrum * theme_spectra[theme_number], fft_length)[:lags]
+        if args.normalize:
+            c = normalize_correlation(c, segment_energy, themes[theme_number][1])
+        peaks[theme_number] = update_top_peaks(peaks[theme_number], c, lag_start, min_distance)
+        if args.charts:
+            update_envelope(envelopes[theme_number], c, lag_start, bin_size)
+
+    def correlate_segment(executor, segment, lag_start):
+        segment_spectrum = fft.rfft(segment, fft_length)
+        segment_energy = get_cumulative_energy(segment) if args.normalize else None
+        list(executor.map(lambda theme_number: correlate_theme(theme_number, segment_spectrum, segment_energy, len(segment), lag_start), range(len(themes))))
+
+    # 5 secs silence prepended to fix matches at the beginning of episode, same as prepare_episode
+    pending = np.zeros(int(5 * match_rate), dtype=np.float32)
+    lag_start = 0
+    episode_length = 0
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        for block in stream_audio(args.input, match_rate, block_length):
+            episode_length += len(block)
+            pending = np.concatenate((pending, block))
+            while len(pending) >= fft_length:
+                correlate_segment(executor, pending[:fft_length], lag_start)
+                pending = pending[block_length:]
+                lag_start += block_length
+        # The rest is shorter than a segment but the shorter themes can still have lags in it
+        while len(pending) >= min(theme_lengths):
+            correlate_segment(executor, pending[:fft_length], lag_start)
+            pending = pending[block_length:]
+            lag_start += block_length
+
+    return peaks, envelopes, bin_size, episode_length
+
+def match_themes_blocks(args, t_path, theme_events):
+    # Every theme is correlated in the same pass over the episode so they all have to be ready first
+    theme_names = []
+    while True:
+        (event, value) = theme_events.get()
+        if event == "themes done":
+            break
+        if event == "theme" and ("OP" in value or "ED" in value):
+            theme_names.append(value)
+
+    print("Matching themes...")
     try:
-        y_episode, sr_episode = librosa.load(str(args.episode_audio_path), sr=None)
+        with audioread.ffdec.FFmpegAudioFile(str(args.input)) as audio_file:
+            sr_episode = audio_file.samplerate
+            duration = audio_file.duration
     except Exception as exc:
-        print(f"Could not load input file - {str(args.episode_audio_path)}: {exc}", file=sys.stderr)
+        print(f"Could not load input file - {str(args.input)}: {exc}", file=sys.stderr)
         sys.exit(1)
+    match_rate = get_match_rate(sr_episode, args)
 
-    with ThreadPoolExecutor(max_workers=2) as executor:
-        future_op = executor.submit(process_themes, t_path, args, op_files, "OP", y_episode, sr_episode)
-        future_ed = executor.submit(process_themes, t_path, args, ed_files, "ED", y_episode, sr_episode)
+    themes = []
+    for theme_name in sorted(theme_names):
+        try:
+            y_theme = load_theme(Path(t_path) / (theme_name + ".ogg"), sr_episode, t_path, args)
+        except Exception as exc:
+            print(f"{theme_name}: Could not load theme file - {exc}", file=sys.stderr)
+            sys.exit(1)
+        theme_duration = len(y_theme) / match_rate
+        themes.append((theme_name, np.array(y_theme[:int(match_rate * ((theme_duration + 5) * args.theme_portion))]), theme_duration))
+    if len(themes) == 0:
+        return [], duration
 
-        for future in as_completed([future_op, future_ed]):
-            offset_list.extend(future.result())
+    silence_length = int(5 * match_rate)
+    try:
+        peaks, envelopes, bin_size, episode_length = correlate_blocks(args, sr_episode, themes, int(duration * match_rate) + silence_length)
+    except Exception as exc:
+        print(f"Could not load input file - {str(args.input)}: {exc}", file=sys.stderr)
+        sys.exit(1)
+
+    # Without matching in parallel the best scoring theme of each type is the one that gets the match
+    required_score = get_required_score(args)
+    matches = []
+    for theme_type in ("OP", "ED"):
+        type_themes = [(theme_number, theme) for (theme_number, theme) in enumerate(themes) if theme_type in theme[0] and len(peaks[theme_number]) > 0]
+        best = max(type_themes, key=lambda type_theme: peaks[type_theme[0]][0][1], default=None)
+        for (theme_number, (theme_name, _, theme_duration)) in type_themes:
+            (match_idx, score) = peaks[theme_number][0]
+            offset = max(round((match_idx - silence_length) / match_rate, 2), 0)
+            matched_time = None
+            if score <= required_score:
+                print(f"{theme_name}: Not matched ({format_score(score, args)})", file=sys.stderr)
+            elif theme_number != best[0]:
+                print(f"{theme_name}: Skipping because already matched an {theme_type}", file=sys.stderr)
+            else:
+                print(f"{theme_name}: Matched from {get_timestamp(offset)} -> {get_timestamp(offset + theme_duration)} ({format_score(score, args)})", file=sys.stderr)
+                matches.append((theme_name, offset, offset + theme_duration))
+                matched_time = get_timestamp(offset)
+            if args.charts:
+                (c_min, c_max) = envelopes[theme_number]
+                queue_chart_envelope(theme_name, np.arange(len(c_min)) * bin_size / match_rate, c_min, c_max, required_score, matched_time, args)
 
-    return offset_list
+    return matches, episode_length / match_rate
 
 def time_to_frame(timesec, framerate, floor = True):
     frame = timesec * framerate
@@ -498,40 +1790,132 @@ def frame_to_time(frame, framerate, floor = True):
 
     return secs
 
-def generate_search_pattern(window):
-    result = [window + 1]
+def get_snap_cache_path(args, extension):
+    # Keyed on the episode file so a re-encode or another episode with the same name never reuses it
+    stat = os.stat(args.input)
+    key = hashlib.sha1(f"{Path(args.input).name}|{stat.st_size}|{stat.st_mtime_ns}".encode()).hexdigest()[:16]
+    snap_path = Path(args.work_path) / ".themes" / "snap"
+    snap_path.mkdir(parents=True, exist_ok=True)
+    return snap_path / f"{Path(args.input).stem}_{key}{extension}"
 
-    for i in range(1, window + 1):
-        result.append(window + 1 - i)
-        result.append(window + 1 + i)
+def read_scene_changes(cache_path):
+    try:
+        with open(cache_path) as data:
+            return {int(frame): scene_change for (frame, scene_change) in json.load(data)["frames"].items()}
+    except Exception:
+        return {}
 
-    return result
+def write_scene_changes(cache_path, scene_changes, fps):
+    # Every frame SCXvid has looked at so far, Chapter_Snapper can use this as its keyframes
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+    with open(tmp_path, "w") as outfile:
+        json.dump({"fps": fps, "frames": {str(frame): scene_changes[frame] for frame in sorted(scene_changes)}}, outfile)
+    os.replace(tmp_path, cache_path)
 
-def get_keyframe_frame(frame, snap_window_frames, clip_length, clip, core):
-    # Generate the keyframes in range with one more at the beginning since the first is always keyframe
-    # Scxvid needs to go sequentially and wwxd is inaccurate in testing
-    search_start_frame = max(frame - snap_window_frames - 1, 0)
-    search_end_frame = min(frame + snap_window_frames, clip_length) # Should already be one more than the last index
-    if search_start_frame >= search_end_frame:
+def get_snap_width(snap_height):
+    return round(snap_height * 16 / 9 / 16) * 16
+
+def scan_scene_changes(start_frame, end_frame, clip, core, scene_changes):
+    # Frames already checked in an earlier run are reused and SCXvid only runs if one in the chunk isn't known
+    if all(actual_frame in scene_changes for actual_frame in range(start_frame, end_frame)):
         return
-    trimmed_clip = clip[search_start_frame:search_end_frame]
+
+    # Scxvid needs to go sequentially and its first frame is always a keyframe so it starts one frame early
+    # wwxd is inaccurate in testing
+    trim_start = start_frame - 1
     try:
-        scxvid_clip = core.scxvid.Scxvid(trimmed_clip)
+        scxvid_clip = core.scxvid.Scxvid(clip[trim_start:end_frame])
     except Exception:
         raise ImportError("You need to install Scxvid in vapoursynth plugins\n"
                           "https://github.com/dubhater/vapoursynth-scxvid")
+    # Request the whole chunk up front and in order so decoding, resizing and SCXvid overlap
+    frame_requests = [(actual_frame, scxvid_clip.get_frame_async(actual_frame - trim_start))
+                      for actual_frame in range(start_frame, end_frame)]
+    for (actual_frame, request) in frame_requests:
+        scene_changes[actual_frame] = bool(request.result().props._SceneChangePrev)
+
+def get_video_info(file_path):
+    # ffmpeg prints the stream info even without an output, fps is rounded so snap it to the exact NTSC rate
+    output = subprocess.run(["ffmpeg", "-hide_banner", "-i", str(file_path)], capture_output=True, text=True, errors="replace").stderr
+    fps_match = re.search(r"Stream #.*?: Video: .*?([\d.]+) fps", output)
+    duration_match = re.search(r"Duration: (\d+):(\d+):([\d.]+)", output)
+    if fps_match is None or duration_match is None:
+        raise Exception(f"Could not find the video stream in {file_path}")
+    fps = float(fps_match.group(1))
+    for base in (24, 30, 48, 60, 120):
+        if abs(fps - base * 1000 / 1001) < 0.01:
+            fps = base * 1000 / 1001
+    duration = int(duration_match.group(1)) * 3600 + int(duration_match.group(2)) * 60 + float(duration_match.group(3))
+    return fps, math.ceil(duration * fps)
+
+def decode_gray_frames(file_path, start_frame, frame_count, fps, snap_height):
+    # Seeks to half a frame before so the first frame out is start_frame, ffmpeg decodes from the keyframe before it
+    width = get_snap_width(snap_height)
+    start_time = max((start_frame - 0.5) / fps, 0)
+    output = subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-ss", f"{start_time:.6f}", "-i", str(file_path),
+                             "-map", "0:v:0", "-fps_mode", "passthrough", "-frames:v", str(frame_count), "-vf", f"scale={width}:{snap_height}:flags=area,format=gray",
+                             "-f", "rawvideo", "-"], capture_output=True)
+    if output.returncode != 0:
+        raise Exception(output.stderr.decode().strip())
+    frames = np.frombuffer(output.stdout, dtype=np.uint8)
+    return frames[:len(frames) // (width * snap_height) * width * snap_height].reshape(-1, snap_height, width)
+
+def detect_scene_changes(frames, has_previous):
+    # Same score as ffmpeg's scdet, the mean absolute frame difference but only as much as it jumped from the
+    # difference before it so steady motion doesn't count. Returns a result for every frame but the first
+    # and the second too if the first frame only gives the difference before the others
+    frame_diffs = np.abs(np.diff(frames.astype(np.int16), axis=0)).mean(axis=(1, 2)) / 255
+    previous_diffs = np.concatenate(([0], frame_diffs[:-1]))
+    scores = np.minimum(frame_diffs, np.abs(frame_diffs - previous_diffs))
+    scene_changes = scores >= SCENE_CHANGE_THRESHOLD
+    return scene_changes[1:] if has_previous else scene_changes
+
+def scan_scene_changes_numpy(file_path, start_frame, end_frame, fps, snap_height, scene_changes):
+    if all(actual_frame in scene_changes for actual_frame in range(start_frame, end_frame)):
+        return
+    # Two frames early so the first frame in the range has a difference before it to compare to
+    decode_start = max(start_frame - 2, 0)
+    frames = decode_gray_frames(file_path, decode_start, end_frame - decode_start, fps, snap_height)
+    results = detect_scene_changes(frames, start_frame - decode_start == 2)
+    for (actual_frame, scene_change) in zip(range(start_frame, end_frame), results):
+        scene_changes[actual_frame] = bool(scene_change)
+
+def get_keyframe_frame(frame, snap_window_frames, clip_length, scan, scene_changes, chunk_size=SNAP_CHUNK):
+    # Walks out from the frame a chunk at a time and stops as soon as the nearest scene change is certain,
+    # so memory stays the same for any window size and usually only a few chunks get decoded
+    first_frame = max(frame - snap_window_frames, 1)
+    last_frame = min(frame + snap_window_frames - 1, clip_length - 1)
+    if first_frame > last_frame:
+        return
 
-    search_pattern = generate_search_pattern(snap_window_frames)
-    for i in search_pattern:
-        if i <= 0 or i >= trimmed_clip.num_frames:
-            continue
-        actual_frame = frame - snap_window_frames - 1 + i
-        props = scxvid_clip.get_frame(i).props
-        scenechange = props._SceneChangePrev
-        if scenechange:
-            return actual_frame
+    # Frames from low_frame up to but not including high_frame have been scanned
+    low_frame = min(max(frame - chunk_size // 2, first_frame), last_frame)
+    high_frame = min(low_frame + chunk_size, last_frame + 1)
+    scan(low_frame, high_frame, scene_changes)
+    while True:
+        # Only trust the distance that has been scanned on both sides so a closer cut can't be missed
+        left_done = low_frame <= first_frame
+        right_done = high_frame > last_frame
+        radius = min(snap_window_frames,
+                     snap_window_frames if left_done else frame - low_frame,
+                     snap_window_frames if right_done else high_frame - 1 - frame)
+        for distance in range(radius + 1):
+            for actual_frame in (frame - distance, frame + distance):
+                if first_frame <= actual_frame <= last_frame and scene_changes.get(actual_frame):
+                    return actual_frame
+        if left_done and right_done:
+            return
+
+        if not left_done and (right_done or frame - low_frame <= high_frame - 1 - frame):
+            chunk_start = max(low_frame - chunk_size, first_frame)
+            scan(chunk_start, low_frame, scene_changes)
+            low_frame = chunk_start
+        else:
+            chunk_end = min(high_frame + chunk_size, last_frame + 1)
+            scan(high_frame, chunk_end, scene_changes)
+            high_frame = chunk_end
 
-def snap(args, offset_list):
+def get_scxvid_scanner(args):
     try:
         import vapoursynth as vs
         from vapoursynth import core
@@ -540,29 +1924,52 @@ def snap(args, offset_list):
                           "https://github.com/vapoursynth/vapoursynth")
 
     try:
-        clip = core.ffms2.Source(source=args.input, cache=False)
+        # The index is kept in the work path so only the first snap of an episode has to index it
+        clip = core.ffms2.Source(source=str(args.input), cachefile=str(get_snap_cache_path(args, ".ffindex")))
     except Exception:
         raise ImportError("Could not load video or you haven't installed ffms2 in vapoursynth plugins for snapping\n"
                           "https://github.com/FFMS/ffms2")
 
+    # SCXvid needs YUV420P8 but the scene changes don't need much resolution to show up
+    clip = core.resize.Bilinear(clip, get_snap_width(args.snap_height), args.snap_height, format=vs.YUV420P8)
+    fps = float(clip.fps.numerator) / float(clip.fps.denominator)
+    def scan(start_frame, end_frame, scene_changes):
+        scan_scene_changes(start_frame, end_frame, clip, core, scene_changes)
+    return scan, fps, clip.num_frames
+
+def get_numpy_scanner(args):
+    fps, clip_length = get_video_info(args.input)
+    def scan(start_frame, end_frame, scene_changes):
+        scan_scene_changes_numpy(args.input, start_frame, end_frame, fps, args.snap_height, scene_changes)
+    return scan, fps, clip_length
+
+def snap(args, offset_list):
+    if args.snap_backend == "numpy":
+        scan, fps, clip_length = get_numpy_scanner(args)
+        scene_changes_path = get_snap_cache_path(args, f"_{args.snap_height}p_numpy.json")
+    else:
+        scan, fps, clip_length = get_scxvid_scanner(args)
+        scene_changes_path = get_snap_cache_path(args, f"_{args.snap_height}p.json")
+
     print(f"Snapping chapters...", end="", flush=True)
 
-    clip = core.resize.Bilinear(clip, 640, 360, format=vs.YUV420P8)
+    scene_changes = read_scene_changes(scene_changes_path)
 
-    clip_length = clip.num_frames
-    fps = float(clip.fps.numerator) / float(clip.fps.denominator)
+    # Every chapter's window is looked at in parallel
+    snap_window_frames = round(args.snap / 1000 * fps)
+    chunk_size = SNAP_CHUNK if args.snap_backend == "scxvid" else SNAP_NUMPY_CHUNK
+    offset_frames = [time_to_frame(offset, fps, floor=False) for offset in offset_list]
+    with ThreadPoolExecutor(max_workers=len(offset_list)) as executor:
+        snap_frames = list(executor.map(lambda offset_frame: get_keyframe_frame(offset_frame, snap_window_frames, clip_length, scan, scene_changes, chunk_size), offset_frames))
 
     snapped_offsets = []
-    for offset in offset_list:
-        offset_frame =  time_to_frame(offset, fps, floor=False)
-        snap_window_frames = round(args.snap / 1000 * fps)
-        snap_frame = get_keyframe_frame(offset_frame, snap_window_frames, clip_length, clip, core)
-
+    for (offset, snap_frame) in zip(offset_list, snap_frames):
         if snap_frame:
             snapped_offsets.append(frame_to_time(snap_frame, fps, floor=True))
         else:
             snapped_offsets.append(offset)
 
+    write_scene_changes(scene_changes_path, scene_changes, fps)
     return snapped_offsets
 
 def print_snapped_times(offset_list, file_duration, args):
@@ -581,34 +1988,151 @@ def print_snapped_times(offset_list, file_duration, args):
     if len(ep_snapped_offsets) == 4:
         print(f"{get_timestamp(ep_snapped_offsets[2])} -> {get_timestamp(ep_snapped_offsets[3])}", file=sys.stderr)
 
+def prepare_episode(y_episode, sr_episode, args):
+    match_rate = get_match_rate(sr_episode, args)
+
+    # 5 secs silence prepended to fix matches at the beginning of episode
+    silence_length = int(5 * match_rate)
+    y_episode_adjust = np.empty(silence_length + len(y_episode), dtype=y_episode.dtype)
+    y_episode_adjust[:silence_length] = 0
+    y_episode_adjust[silence_length:] = y_episode
+
+    coarse_factor = 1
+    if args.coarse_downsample is not None:
+        coarse_factor = round(args.coarse_downsample / args.downsample)
+    return EpisodeSpectrum(y_episode_adjust, match_rate, coarse_factor, workers=args.fft_threads, normalize=args.normalize)
+
+def run_episode(args, t_path, download=False):
+    start_charts(args)
+
+    # The episode gets decoded at the same time as themes are searched for and downloaded
+    theme_events = queue.Queue()
+    if args.max_memory is not None:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            themes_future = executor.submit(fetch_themes, args, t_path, theme_events, download)
+            matches, file_duration = match_themes_blocks(args, t_path, theme_events)
+            themes_future.result()
+    else:
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            episode_future = executor.submit(extract_episode_audio, args)
+            themes_future = executor.submit(fetch_themes, args, t_path, theme_events, download)
+            y_episode, sr_episode = episode_future.result()
+            file_duration = len(y_episode) / get_match_rate(sr_episode, args)
+            episode = prepare_episode(y_episode, sr_episode, args)
+            del y_episode
+
+            matches = match_themes(args, t_path, episode, sr_episode, theme_events)
+            themes_future.result()
+
+    offset_list = sorted(offset for (_, offset1, offset2) in matches for offset in (offset1, offset2))
+    valid = chapter_validator(offset_list, file_duration)
+    if valid:
+        if args.snap:
+            print_seperator()
+            offset_list = snap(args, offset_list)
+            print_snapped_times(offset_list, file_duration, args)
+        generate_chapters(offset_list, file_duration, args)
+    return matches, valid
+
+def process_episode(args, episode, t_path):
+    episode_args = copy.copy(args)
+    episode_args.input = episode
+    if args.output is None:
+        episode_args.output = episode.with_name(episode.stem + ".chapters.txt")
+    else:
+        episode_args.output = args.output / (episode.stem + ".chapters.txt")
+    episode_args.charts_path = args.charts_path / episode.stem
+    episode_args.charts_path.mkdir(parents=True, exist_ok=True)
+
+    start_time = time.perf_counter()
+    try:
+        matches, valid = run_episode(episode_args, t_path)
+        result = "Chapters written" if valid else "No chapters"
+    except SystemExit: # Errors in a single episode exit so catch them to keep the batch going
+        matches = []
+        result = "Failed"
+    except Exception as exc:
+        matches = []
+        result = f"Failed - {exc}"
+
+    # Worker processes don't wait for their own background work on exit
+    episode_time = time.perf_counter() - start_time
+    finish_charts()
+    return episode.name, matches, result, episode_time
+
+def preload_themes(args, t_path):
+    # Decode themes into .themes/cache once in the main process so the workers only memory map them instead of
+    # all decoding the same themes at the same time. Workers started with fork also inherit the decoded themes,
+    # with spawn (Windows, macOS and Linux from Python 3.14) they start empty and map them from the cache
+    try:
+        with ThreadPoolExecutor(max_workers=args.parallel_episodes) as executor:
+            sample_rates = list(executor.map(get_sample_rate, args.episodes))
+        theme_files = [(os.path.splitext(theme_file.name)[0], Path(theme_file.path)) for theme_file in os.scandir(t_path) if theme_file.name.endswith(".ogg")]
+        # Themes get decoded at every sample rate the episodes have
+        for sr_episode in sorted(set(sample_rates)):
+            for (_, theme_path) in theme_files:
+                load_theme(theme_path, sr_episode, t_path, args)
+        # There's only one fingerprint index so it's built for the rate most episodes have
+        if args.fingerprint and len(theme_files) > 0:
+            load_fingerprint_index(t_path, theme_files, max(set(sample_rates), key=sample_rates.count), args)
+    except Exception as exc:
+        print(f"Could not preload themes: {exc}", file=sys.stderr)
+
+def print_batch_summary(results, total_time):
+    print_seperator()
+    rows = [("Episode", "OP", "ED", "Result", "Time")]
+    for (episode_name, matches, result, episode_time) in results:
+        op_matches = ", ".join(f"{theme_name} {get_timestamp(offset1)}" for (theme_name, offset1, _) in matches if "OP" in theme_name)
+        ed_matches = ", ".join(f"{theme_name} {get_timestamp(offset1)}" for (theme_name, offset1, _) in matches if "ED" in theme_name)
+        rows.append((episode_name, op_matches or "-", ed_matches or "-", result, f"{episode_time:.1f}s"))
+
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(cell.ljust(width) for (cell, width) in zip(row, widths)).rstrip())
+    print(f"Matched {len(results)} episodes in {total_time:.1f}s")
+
+def run_batch(args, t_path):
+    if args.output is not None:
+        args.output.mkdir(parents=True, exist_ok=True)
+
+    start_time = time.perf_counter()
+    preload_themes(args, t_path)
+    print(f"Matching {len(args.episodes)} episodes...")
+
+    results = []
+    with ProcessPoolExecutor(max_workers=args.parallel_episodes) as executor:
+        futures = [executor.submit(process_episode, args, episode, t_path) for episode in args.episodes]
+        for future in as_completed(futures):
+            results.append(future.result())
+
+    results.sort(key=lambda result: result[0])
+    print_batch_summary(results, time.perf_counter() - start_time)
+
 def main():
     args = parse_args()
+    if args.render_charts is not None:
+        render_charts(args.render_charts)
+        return
+    if args.gc_theme_store:
+        gc_theme_store(args)
+        return
+
     t_path = os.path.join(args.work_path, ".themes")
 
     try:
         validate_themes(args, t_path)
         make_folders(args.work_path)
-        try_download(args, t_path)
-        extract_episode_audio(args)
-        offset_list = match_themes(args, t_path)
-
-        file_duration = librosa.get_duration(path=str(args.episode_audio_path))
-
-        offset_list.sort()
-        if chapter_validator(offset_list, file_duration):
-            if args.snap:
-                print_seperator()
-                offset_list = snap(args, offset_list)
-                print_snapped_times(offset_list, file_duration, args)
-            generate_chapters(offset_list, file_duration, args)
+        if args.batch:
+            try_download(args, t_path)
+            run_batch(args, t_path)
+        else:
+            run_episode(args, t_path, download=True)
     finally:
+        finish_charts()
         if args.delete_themes:
+            # Unmaps the cached themes first, Windows can't delete them while they're mapped
+            loaded_themes.clear()
             shutil.rmtree(t_path)
-        try:
-            if args.episode_audio_path.endswith(".autochap.wav"):
-                os.remove(args.episode_audio_path)
-        except Exception:
-            pass
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,166 @@
+import re
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+import collections
+import urllib.parse
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for the parts of the AnimeThemes API that Auto_Chap uses
+# Serves one series made from a folder of theme files named like OP1.ogg, OP1v2.ogg, ED1.ogg
+# Point Auto_Chap at it with --api-url http://127.0.0.1:PORT
+
+CHUNK_SIZE = 1 << 14
+
+
+def load_fixture(fixture_path, series_name, updated_at="2024-01-01T00:00:00.000000Z"):
+    # Groups theme files into the themes -> entries -> videos -> audio shape of anime/{slug}
+    themes = collections.OrderedDict()
+    for path in sorted(Path(fixture_path).glob("*.ogg")):
+        match = re.fullmatch(r"((?:OP|ED)\d+)(?:v(\d+))?", path.stem)
+        if match is None:
+            continue
+        themes.setdefault(match.group(1), []).append((int(match.group(2) or 1), path))
+
+    slug = re.sub(r"[^a-z0-9]+", "_", series_name.lower()).strip("_")
+    files = {}
+    animethemes = []
+    for (theme_slug, versions) in themes.items():
+        entries = []
+        for (_, path) in sorted(versions):
+            filename = f"{slug}-{path.stem}"
+            files[filename + ".ogg"] = path
+            audio = {"filename": filename, "updated_at": updated_at, "link": None}
+            entries.append({"videos": [{"overlap": "None", "audio": audio}]})
+        animethemes.append({"slug": theme_slug, "animethemeentries": entries})
+    return {"name": series_name, "slug": slug, "animethemes": animethemes}, files
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        time.sleep(server.latency)
+
+        if url.path == "/search":
+            with server.stats_lock:
+                server.stats["search"] += 1
+            search = " ".join(query.get("q", [""])[0].lower().split())
+            found = search in server.series["name"].lower() or search in server.series["slug"]
+            anime = [{"name": server.series["name"], "slug": server.series["slug"]}] if found else []
+            self.send_json({"search": {"anime": anime}})
+        elif url.path == f"/anime/{server.series['slug']}":
+            with server.stats_lock:
+                server.stats["anime"] += 1
+            self.send_json({"anime": server.series})
+        elif url.path.startswith("/audio/") and url.path[len("/audio/"):] in server.files:
+            self.send_audio(server.files[url.path[len("/audio/"):]])
+        else:
+            self.send_error(404)
+
+    def send_json(self, data):
+        server = self.server
+        body = json.dumps(data).encode()
+        etag = '"' + hashlib.sha1(body).hexdigest() + '"'
+        if self.headers.get("If-None-Match") == etag:
+            with server.stats_lock:
+                server.stats["not_modified"] += 1
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_audio(self, path):
+        server = self.server
+        data = path.read_bytes()
+        start = 0
+        range_match = re.fullmatch(r"bytes=(\d+)-", self.headers.get("Range", ""))
+        if range_match is not None:
+            start = int(range_match.group(1))
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{len(data)}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Type", "audio/ogg")
+        self.send_header("Content-Length", str(len(data) - start))
+        self.end_headers()
+
+        with server.stats_lock:
+            server.stats["audio"] += 1
+        # Each connection gets the whole bandwidth, like separate downloads from a CDN
+        sent_start = time.perf_counter()
+        for offset in range(start, len(data), CHUNK_SIZE):
+            chunk = data[offset:offset + CHUNK_SIZE]
+            self.wfile.write(chunk)
+            with server.stats_lock:
+                server.stats["audio_bytes"] += len(chunk)
+            if server.bandwidth:
+                ahead = (offset + len(chunk) - start) / server.bandwidth - (time.perf_counter() - sent_start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+
+def serve(fixture_path, series_name, latency=0, bandwidth=None, host="127.0.0.1", port=0):
+    # Starts the stand-in on a background thread, use server.url for --api-url and server.shutdown() to stop it
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.url = f"http://{host}:{server.server_port}"
+    server.series, server.files = load_fixture(fixture_path, series_name)
+    for theme in server.series["animethemes"]:
+        for entry in theme["animethemeentries"]:
+            audio = entry["videos"][0]["audio"]
+            audio["link"] = f"{server.url}/audio/{audio['filename']}.ogg"
+    server.latency = latency
+    server.bandwidth = bandwidth
+    server.stats = collections.Counter()
+    server.stats_lock = threading.Lock()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local stand-in for the AnimeThemes API serving one series from a folder of themes")
+    parser.add_argument("fixture", type=Path, help="Folder of theme files named like OP1.ogg, OP1v2.ogg and ED1.ogg")
+    parser.add_argument("--name", default="Stub Series", help="Series name that searches have to be part of")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds added before every response")
+    parser.add_argument("--bandwidth", type=float, help="Bytes per second each audio download is limited to")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+
+    server = serve(args.fixture, args.name, args.latency, args.bandwidth, port=args.port)
+    if len(server.files) == 0:
+        print(f"No themes found in {args.fixture}", file=sys.stderr)
+        sys.exit(1)
+    print(f"Serving {len(server.files)} themes of {args.name} at {server.url}", file=sys.stderr)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
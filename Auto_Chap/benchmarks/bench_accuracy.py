@@ -0,0 +1,177 @@
+import io
+import sys
+import json
+import time
+import queue
+import argparse
+import tempfile
+import itertools
+import contextlib
+import tracemalloc
+import statistics
+from pathlib import Path
+
+import synthetic
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import Auto_Chap
+
+# Matches synthetic episodes with themes at known offsets across a grid of matching parameters and reports
+# how long it took, peak memory, offset error and false matches. Every result is a JSON line so runs of
+# different versions of the matching can be compared.
+
+TOLERANCE = 1 # Seconds an offset can be off by and still count as correct
+THEME_TYPES = ("OP", "ED") # Every episode can get at most one match of each
+
+
+def get_cases(episode_length):
+    # (name, filler, OP start or None, ED start or None, gain, EQ or None), offsets are where the theme starts
+    # even when that is before the episode so the expected chapter gets clamped to 0
+    ed_start = episode_length - 150
+    return [
+        ("noise", None, 90, ed_start, 0.8, None),
+        ("speech", 0.8, 90, ed_start, 0.8, None),
+        ("op-at-start", 0.8, 0, ed_start, 0.8, None),
+        ("op-cut-start", 0.8, -8, ed_start, 0.8, None),
+        ("ed-cut-end", 0.8, 90, episode_length - synthetic.THEME_LENGTH + 8, 0.8, None),
+        ("quiet", 0.8, 90, ed_start, 0.25, None),
+        ("eq", 0.8, 90, ed_start, 0.8, (2.0, 0.3)),
+        ("op-only", 0.8, 90, None, 0.8, None),
+        ("no-themes", 0.8, None, None, 0.8, None),
+    ]
+
+
+def build_fixture(path, args):
+    # OP2 and ED2 never appear in an episode so they can only ever be false matches
+    themes_path, themes = synthetic.write_themes(path, ["OP1", "ED1", "OP2", "ED2"], 300)
+
+    cases = []
+    for (case_number, (name, speech, op_start, ed_start, gain, eq)) in enumerate(get_cases(args.episode_length)):
+        expected = {}
+        placed = []
+        for (theme_type, start) in (("OP", op_start), ("ED", ed_start)):
+            if start is None:
+                continue
+            y_theme = themes[f"{theme_type}1"]
+            if eq is not None:
+                y_theme = synthetic.equalize(y_theme, *eq)
+            placed.append((y_theme, start, gain))
+            expected[theme_type] = (f"{theme_type}1", max(start, 0))
+        episode = path / f"{name}.mkv"
+        synthetic.write_audio(episode, synthetic.make_episode(args.episode_length, placed, seed=case_number, speech=speech))
+        cases.append((name, episode, expected))
+    return themes_path, cases
+
+
+def get_args(episode, work_path, params, extra_args):
+    # Cached match results would make every run after the first on an episode look instant
+    argv = ["--no-match-cache"]
+    for (name, value) in params.items():
+        argv += [f"--{name.replace('_', '-')}", str(value)]
+    return synthetic.get_args(episode, work_path, argv + extra_args)
+
+
+def run_case(args, t_path, expected):
+    # Decoded themes are kept on disk but not in memory so every run loads them the same way
+    Auto_Chap.loaded_themes.clear()
+    theme_events = queue.Queue()
+    for theme_file in sorted(Path(t_path).glob("*.ogg")):
+        theme_events.put(("theme", theme_file.stem))
+    theme_events.put(("themes done", None))
+
+    tracemalloc.start()
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        start = time.perf_counter()
+        y_episode, sr_episode = Auto_Chap.extract_episode_audio(args)
+        episode = Auto_Chap.prepare_episode(y_episode, sr_episode, args)
+        del y_episode
+        decoded = time.perf_counter()
+        matches = Auto_Chap.match_themes(args, t_path, episode, sr_episode, theme_events)
+        finished = time.perf_counter()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    errors = []
+    false_matches = []
+    for (theme_name, offset, _) in matches:
+        theme_type = "OP" if "OP" in theme_name else "ED"
+        if theme_type in expected and expected[theme_type][0] == theme_name and abs(offset - expected[theme_type][1]) <= TOLERANCE:
+            errors.append(round(abs(offset - expected[theme_type][1]), 3))
+        else:
+            false_matches.append(f"{theme_name}@{offset}")
+    return {
+        "decode_seconds": round(decoded - start, 3),
+        "match_seconds": round(finished - decoded, 3),
+        "peak_mb": round(peak_memory / 1e6, 1),
+        "expected": len(expected),
+        "correct": len(errors),
+        "missed": len(expected) - len(errors),
+        "false_matches": false_matches,
+        "offset_errors": errors,
+    }
+
+
+def print_summary(results, grid_names):
+    rows = [tuple(grid_names) + ("hit rate", "false rate", "mean err", "max err", "match s", "peak MB")]
+    for (params, runs) in itertools.groupby(results, key=lambda result: tuple(result["params"][name] for name in grid_names)):
+        runs = list(runs)
+        expected = sum(run["expected"] for run in runs)
+        # Share of the OP and ED slots of every episode that got filled with a wrong match
+        slots = len(THEME_TYPES) * len(runs)
+        errors = [error for run in runs for error in run["offset_errors"]]
+        rows.append(tuple(str(param) for param in params) + (
+            f"{sum(run['correct'] for run in runs) / max(expected, 1):.0%}",
+            f"{sum(len(run['false_matches']) for run in runs) / slots:.0%}",
+            f"{statistics.mean(errors):.3f}" if errors else "-",
+            f"{max(errors):.3f}" if errors else "-",
+            f"{statistics.mean(run['match_seconds'] for run in runs):.2f}",
+            f"{max(run['peak_mb'] for run in runs):.0f}",
+        ))
+    widths = [max(len(row[column]) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        print("  ".join(cell.rjust(width) for (cell, width) in zip(row, widths)), file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Accuracy and speed of theme matching on synthetic episodes across a parameter grid")
+    parser.add_argument("--downsample", type=int, nargs="+", default=[16, 32, 64])
+    parser.add_argument("--score", type=int, nargs="+", default=[1000, 2000, 4000])
+    parser.add_argument("--theme-portion", type=float, nargs="+", default=[0.8, 0.9])
+    parser.add_argument("--episode-length", type=float, default=600, help="Seconds per synthetic episode")
+    parser.add_argument("--cases", nargs="+", help="Only run these cases")
+    parser.add_argument("--output", "-o", type=Path, help="Write the JSON lines here instead of stdout")
+    args, auto_chap_args = parser.parse_known_args()
+    grid = {"downsample": args.downsample, "score": args.score, "theme_portion": args.theme_portion}
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print("Generating episodes...", file=sys.stderr)
+        t_path, cases = build_fixture(tmp, args)
+        if args.cases is not None:
+            cases = [case for case in cases if case[0] in args.cases]
+
+        # Imports and first use costs shouldn't land on whichever case happens to run first
+        (_, episode, expected) = cases[0]
+        run_case(get_args(episode, tmp, {name: values[0] for (name, values) in grid.items()}, auto_chap_args), str(t_path), expected)
+
+        outfile = open(args.output, "w") if args.output is not None else sys.stdout
+        try:
+            for values in itertools.product(*grid.values()):
+                params = dict(zip(grid, values))
+                for (name, episode, expected) in cases:
+                    case_args = get_args(episode, tmp, params, auto_chap_args)
+                    result = {"case": name, "params": params, "extra_args": auto_chap_args}
+                    result.update(run_case(case_args, str(t_path), expected))
+                    results.append(result)
+                    outfile.write(json.dumps(result) + "\n")
+                    outfile.flush()
+        finally:
+            if outfile is not sys.stdout:
+                outfile.close()
+
+    print_summary(results, list(grid))
+
+
+if __name__ == "__main__":
+    main()
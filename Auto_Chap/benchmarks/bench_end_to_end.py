@@ -0,0 +1,130 @@
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+import animethemes_stub
+import synthetic
+
+# Runs Auto_Chap end to end against the local AnimeThemes stand-in so downloads, caches and matching can be
+# measured without network access. Every run is a fresh process so nothing carries over in memory.
+
+SCRIPT = Path(__file__).resolve().parent.parent / "Auto_Chap.py"
+SERIES_NAME = "Benchmark Series"
+THEME_LENGTH = 90
+
+
+def build_fixture(path, args):
+    fixture_path = path / "fixture"
+    fixture_path.mkdir()
+    themes = {}
+    for (theme_type, count, seed) in (("OP", args.ops, 100), ("ED", args.eds, 200)):
+        for number in range(1, count + 1):
+            y = synthetic.make_theme(THEME_LENGTH, seed + number)
+            themes[f"{theme_type}{number}"] = y
+            for version in range(1, args.versions + 1):
+                suffix = f"v{version}" if version > 1 else ""
+                # Later versions are the same song at a slightly different level, like re-encodes
+                synthetic.write_audio(fixture_path / f"{theme_type}{number}{suffix}.ogg", y * (1 - 0.05 * (version - 1)))
+
+    episodes = []
+    for number in range(1, args.episodes + 1):
+        episode = path / "episodes" / f"episode{number:02}.mkv"
+        episode.parent.mkdir(exist_ok=True)
+        y = synthetic.make_episode(args.episode_length, [(themes["OP1"], 30, 0.8),
+                                                         (themes["ED1"], args.episode_length - 120, 0.8)], seed=number)
+        synthetic.write_audio(episode, y)
+        episodes.append(episode)
+    return fixture_path, episodes
+
+
+def run_auto_chap(server, episode, work_path, theme_store, extra_args):
+    chapters = episode.with_name(episode.stem + ".chapters.txt")
+    chapters.unlink(missing_ok=True)
+    cmd = [sys.executable, str(SCRIPT), "--input", str(episode), "--search-name", SERIES_NAME,
+           "--api-url", server.url, "--work-path", str(work_path), "--theme-store", str(theme_store)] + extra_args
+    with server.stats_lock:
+        before = server.stats.copy()
+    start = time.perf_counter()
+    output = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    elapsed = time.perf_counter() - start
+    with server.stats_lock:
+        requests = server.stats - before
+    return {
+        "seconds": round(elapsed, 3),
+        "returncode": output.returncode,
+        "chapters": chapters.is_file(),
+        "api_requests": requests["search"] + requests["anime"],
+        "not_modified": requests["not_modified"],
+        "audio_requests": requests["audio"],
+        "audio_mb": round(requests["audio_bytes"] / 1e6, 3),
+        "output": output.stdout,
+    }
+
+
+def get_scenarios(args):
+    # (name, fresh work path, Auto_Chap arguments)
+    scenarios = []
+    for parallel_dl in args.parallel_dl:
+        scenarios.append((f"cold dl={parallel_dl}", True, ["--parallel-dl", str(parallel_dl)]))
+    scenarios.append(("warm", False, []))
+    scenarios.append(("revalidate", False, ["--api-cache-ttl", "0"]))
+    return scenarios
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end Auto_Chap benchmark against a local AnimeThemes stand-in")
+    parser.add_argument("--episodes", type=int, default=1, help="Episodes run one after another per scenario")
+    parser.add_argument("--episode-length", type=float, default=600, help="Seconds per synthetic episode")
+    parser.add_argument("--ops", type=int, default=2, help="OPs in the series")
+    parser.add_argument("--eds", type=int, default=2, help="EDs in the series")
+    parser.add_argument("--versions", type=int, default=2, help="Versions of every theme")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds the stand-in waits before every response")
+    parser.add_argument("--bandwidth", type=float, default=2e6, help="Bytes per second for each audio download")
+    parser.add_argument("--parallel-dl", type=int, nargs="+", default=[1, 4, 10], help="--parallel-dl values to run cold")
+    parser.add_argument("--json", type=Path, help="Also write the results here as JSON")
+    parser.add_argument("--verbose", "-v", action="store_true", help="Print Auto_Chap's output for every run")
+    args, auto_chap_args = parser.parse_known_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print("Generating fixture...", file=sys.stderr)
+        fixture_path, episodes = build_fixture(tmp, args)
+        server = animethemes_stub.serve(fixture_path, SERIES_NAME, args.latency, args.bandwidth)
+        work_path = tmp / "work"
+        theme_store = tmp / "store"
+
+        results = []
+        try:
+            for (name, fresh, scenario_args) in get_scenarios(args):
+                if fresh:
+                    shutil.rmtree(work_path, ignore_errors=True)
+                    shutil.rmtree(theme_store, ignore_errors=True)
+                work_path.mkdir(exist_ok=True)
+                runs = []
+                for episode in episodes:
+                    run = run_auto_chap(server, episode, work_path, theme_store, scenario_args + auto_chap_args)
+                    if args.verbose or run["returncode"] != 0:
+                        print(run["output"], file=sys.stderr)
+                    del run["output"]
+                    runs.append(run)
+                results.append({"scenario": name, "runs": runs})
+                total = sum(run["seconds"] for run in runs)
+                print(f"{name:<16} {total / len(runs):7.2f}s/episode  api {sum(run['api_requests'] for run in runs):3}"
+                      f"  304 {sum(run['not_modified'] for run in runs):3}  audio {sum(run['audio_requests'] for run in runs):3}"
+                      f"  {sum(run['audio_mb'] for run in runs):7.2f} MB  chapters {sum(run['chapters'] for run in runs)}/{len(runs)}")
+        finally:
+            server.shutdown()
+
+    if args.json is not None:
+        with open(args.json, "w") as outfile:
+            json.dump({"config": {key: value for (key, value) in vars(args).items() if key != "json"}, "results": results},
+                      outfile, indent=4, default=str)
+
+
+if __name__ == "__main__":
+    main()
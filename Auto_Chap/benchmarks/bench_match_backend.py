@@ -0,0 +1,92 @@
+import io
+import os
+import sys
+import json
+import time
+import queue
+import argparse
+import tempfile
+import contextlib
+import statistics
+from pathlib import Path
+
+import synthetic
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import Auto_Chap
+
+# Times matching one synthetic episode against a set of themes with the threads and processes match backends
+# at different job counts. None of the themes are in the episode so every one gets correlated instead of
+# being skipped once one matches, which keeps runs comparable.
+
+
+def build_fixture(path, args):
+    names = [f"{'OP' if number % 2 == 0 else 'ED'}{number // 2 + 1}" for number in range(args.themes)]
+    themes_path, _ = synthetic.write_themes(path, names, 500)
+    episode = path / "episode.mkv"
+    synthetic.write_audio(episode, synthetic.make_episode(args.episode_length, [], speech=0.8))
+    return themes_path, episode
+
+
+def get_args(episode, work_path, backend, jobs, extra_args):
+    return synthetic.get_args(episode, work_path, ["--no-match-cache", "--match-backend", backend, "--jobs", str(jobs)] + extra_args)
+
+
+def run_match(args, t_path, episode, sr_episode):
+    theme_events = queue.Queue()
+    for theme_file in sorted(Path(t_path).glob("*.ogg")):
+        theme_events.put(("theme", theme_file.stem))
+    theme_events.put(("themes done", None))
+    with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+        start = time.perf_counter()
+        # A fresh window of the episode every run so its spectrum isn't reused from the run before
+        matches = Auto_Chap.match_themes(args, t_path, episode.window(0, len(episode.y)), sr_episode, theme_events)
+    return time.perf_counter() - start, matches
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the threads and processes match backends across job counts")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8, 16], help="--jobs values to run")
+    parser.add_argument("--backends", nargs="+", choices=["threads", "processes"], default=["threads", "processes"])
+    parser.add_argument("--themes", type=int, default=16, help="Themes to match, half OPs and half EDs")
+    parser.add_argument("--episode-length", type=float, default=1440, help="Seconds of synthetic episode")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs of every combination, the median is reported")
+    parser.add_argument("--json", type=Path, help="Also write the results here as JSON")
+    args, auto_chap_args = parser.parse_known_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        print("Generating episode and themes...", file=sys.stderr)
+        t_path, episode_path = build_fixture(tmp, args)
+        base_args = get_args(episode_path, tmp, "threads", 1, auto_chap_args)
+        with contextlib.redirect_stdout(io.StringIO()):
+            y_episode, sr_episode = Auto_Chap.extract_episode_audio(base_args)
+        episode = Auto_Chap.prepare_episode(y_episode, sr_episode, base_args)
+        del y_episode
+
+        # Decodes every theme into the cache first so only matching gets timed
+        run_match(base_args, str(t_path), episode, sr_episode)
+
+        print(f"{os.cpu_count()} CPUs, {args.themes} themes, {args.episode_length:g}s episode", file=sys.stderr)
+        for jobs in args.jobs:
+            for backend in args.backends:
+                match_args = get_args(episode_path, tmp, backend, jobs, auto_chap_args)
+                times = []
+                for _ in range(args.repeats):
+                    Auto_Chap.loaded_themes.clear()
+                    elapsed, matches = run_match(match_args, str(t_path), episode, sr_episode)
+                    times.append(elapsed)
+                result = {"backend": backend, "jobs": jobs, "seconds": round(statistics.median(times), 3),
+                          "runs": [round(elapsed, 3) for elapsed in times], "false_matches": len(matches)}
+                results.append(result)
+                print(f"{backend:<10} jobs {jobs:3}  {result['seconds']:7.2f}s  {args.themes / result['seconds']:6.1f} themes/s", file=sys.stderr)
+
+    if args.json is not None:
+        with open(args.json, "w") as outfile:
+            json.dump({"config": {key: value for (key, value) in vars(args).items() if key != "json"},
+                       "cpus": os.cpu_count(), "results": results}, outfile, indent=4, default=str)
+
+
+if __name__ == "__main__":
+    main()
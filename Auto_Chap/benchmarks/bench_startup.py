@@ -0,0 +1,78 @@
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+import tempfile
+from pathlib import Path
+
+# Measures how long Auto_Chap takes to print something for invocations that never need to match anything
+# and checks that none of the slow optional modules get imported on the way
+
+SCRIPT = Path(__file__).resolve().parent.parent / "Auto_Chap.py"
+HEAVY_MODULES = ["scipy", "matplotlib", "requests", "librosa"]
+
+IMPORT_CHECK = """
+import sys, runpy
+sys.argv = sys.argv[1:]
+try:
+    runpy.run_path(sys.argv[0], run_name="__main__")
+except SystemExit:
+    pass
+print("\\nLOADED=" + ",".join(m for m in {modules!r} if m in sys.modules))
+"""
+
+
+def get_cases(work_path):
+    return {
+        "help": ["--help"],
+        "missing-input": [],
+        "no-themes": ["--input", str(work_path / "episode.mkv"), "--work-path", str(work_path)],
+    }
+
+
+def time_to_first_output(cmd_args):
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, str(SCRIPT)] + cmd_args,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    proc.stdout.read(1)
+    first_output = time.perf_counter() - start
+    proc.communicate()
+    return first_output * 1000
+
+
+def loaded_heavy_modules(cmd_args):
+    check = IMPORT_CHECK.format(modules=HEAVY_MODULES)
+    out = subprocess.run([sys.executable, "-c", check, str(SCRIPT)] + cmd_args,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True).stdout
+    loaded = out.rsplit("LOADED=", 1)[-1].strip()
+    return [m for m in loaded.split(",") if m]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time to first output for Auto_Chap invocations that don't match anything")
+    parser.add_argument("--runs", "-n", default=10, type=int, help="Runs per case, the median is reported")
+    parser.add_argument("--max-ms", type=float, help="Exit with an error if any case's median is above this many ms")
+    args = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, cmd_args in get_cases(Path(tmp)).items():
+            times = [time_to_first_output(cmd_args) for _ in range(args.runs)]
+            median = statistics.median(times)
+            loaded = loaded_heavy_modules(cmd_args)
+            status = ""
+            if loaded:
+                status += f"  imported {', '.join(loaded)}"
+                failed = True
+            if args.max_ms is not None and median > args.max_ms:
+                status += f"  over {args.max_ms:g} ms budget"
+                failed = True
+            print(f"{name:<15} median {median:7.1f} ms  min {min(times):7.1f} ms{status}")
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
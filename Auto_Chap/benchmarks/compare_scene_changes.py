@@ -0,0 +1,175 @@
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+import synthetic
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import Auto_Chap
+
+# Compares the scene change backends used for snapping on a generated clip with cuts at known frames.
+# Reports how many of the real cuts each backend finds, how often they agree with each other and where
+# chapters at random times get snapped to. SCXvid is skipped when VapourSynth isn't installed.
+
+FPS = "24000/1001"
+# Sources the clip gets cut between, some move a lot so steady motion doesn't get counted as cuts
+SOURCES = [
+    "testsrc2=size={size}:rate={fps}",
+    "mandelbrot=size={size}:rate={fps}",
+    "smptebars=size={size}:rate={fps}",
+    "gradients=size={size}:rate={fps}:speed=0.05",
+    "rgbtestsrc=size={size}:rate={fps}",
+    "cellauto=size={size}:rate={fps}:rule=18",
+]
+TOLERANCE = 1 # Frames a detected cut can be off by and still count
+
+
+def build_clip(path, args):
+    # Segments of random length from the sources one after another, the cuts are where each segment starts
+    rng = random.Random(args.seed)
+    inputs = []
+    filters = []
+    cuts = []
+    frame = 0
+    for number in range(args.segments):
+        source = SOURCES[number % len(SOURCES)].format(size=f"{args.width}x{args.height}", fps=FPS)
+        length = rng.randint(round(args.min_length * 24), round(args.max_length * 24))
+        inputs += ["-f", "lavfi", "-i", source]
+        filters.append(f"[{number}]trim=end_frame={length},setpts=PTS-STARTPTS,format=yuv420p[s{number}]")
+        if number > 0:
+            cuts.append(frame)
+        frame += length
+    filters.append("".join(f"[s{number}]" for number in range(args.segments)) + f"concat=n={args.segments}:v=1[v]")
+    subprocess.run(["ffmpeg", "-y", "-hide_banner", "-loglevel", "error"] + inputs +
+                   ["-filter_complex", ";".join(filters), "-map", "[v]", "-c:v", "libx264", "-preset", "veryfast",
+                    "-g", "240", str(path)], check=True)
+    return cuts, frame
+
+
+def get_scanner(backend, args):
+    if backend == "numpy":
+        return Auto_Chap.get_numpy_scanner(args)
+    return Auto_Chap.get_scxvid_scanner(args)
+
+
+def scan_clip(backend, args, chunk):
+    # Every frame in the clip the same way snapping scans a window, in chunks from the start
+    scan, fps, clip_length = get_scanner(backend, args)
+    chunk_size = Auto_Chap.SNAP_CHUNK if backend == "scxvid" else chunk
+    scene_changes = {}
+    start = time.perf_counter()
+    for chunk_start in range(1, clip_length, chunk_size):
+        scan(chunk_start, min(chunk_start + chunk_size, clip_length), scene_changes)
+    elapsed = time.perf_counter() - start
+    return {frame for (frame, scene_change) in scene_changes.items() if scene_change}, elapsed
+
+
+def snap_targets(backend, args, target_frames):
+    # Same as snap() without the cache so every run starts cold
+    scan, fps, clip_length = get_scanner(backend, args)
+    snap_window_frames = round(args.snap / 1000 * fps)
+    chunk_size = Auto_Chap.SNAP_CHUNK if backend == "scxvid" else Auto_Chap.SNAP_NUMPY_CHUNK
+    scene_changes = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=len(target_frames)) as executor:
+        snap_frames = list(executor.map(lambda frame: Auto_Chap.get_keyframe_frame(frame, snap_window_frames, clip_length, scan, scene_changes, chunk_size), target_frames))
+    return snap_frames, time.perf_counter() - start, len(scene_changes)
+
+
+def get_expected_snap(frame, cuts, snap_window_frames, clip_length):
+    # The nearest real cut in the window, earlier first on a tie like get_keyframe_frame
+    first_frame = max(frame - snap_window_frames, 1)
+    last_frame = min(frame + snap_window_frames - 1, clip_length - 1)
+    for distance in range(snap_window_frames + 1):
+        for actual_frame in (frame - distance, frame + distance):
+            if first_frame <= actual_frame <= last_frame and actual_frame in cuts:
+                return actual_frame
+
+
+def score_cuts(detected, cuts):
+    found = [cut for cut in cuts if any(abs(cut - frame) <= TOLERANCE for frame in detected)]
+    false = [frame for frame in detected if all(abs(cut - frame) > TOLERANCE for cut in cuts)]
+    return {
+        "recall": round(len(found) / max(len(cuts), 1), 3),
+        "precision": round((len(detected) - len(false)) / max(len(detected), 1), 3),
+        "missed": sorted(set(cuts) - set(found)),
+        "false": sorted(false),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the SCXvid and numpy scene change backends on a clip with known cuts")
+    parser.add_argument("--segments", type=int, default=16, help="Segments in the generated clip")
+    parser.add_argument("--min-length", type=float, default=1, help="Shortest segment in seconds")
+    parser.add_argument("--max-length", type=float, default=6, help="Longest segment in seconds")
+    parser.add_argument("--width", type=int, default=960)
+    parser.add_argument("--height", type=int, default=540)
+    parser.add_argument("--targets", type=int, default=40, help="Random chapter times to snap")
+    parser.add_argument("--chunk", type=int, default=240, help="Frames the numpy backend decodes at a time when scanning the whole clip")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--clip", type=Path, help="Keep the generated clip here instead of a temporary folder")
+    parser.add_argument("--json", type=Path, help="Also write the results here as JSON")
+    args, auto_chap_args = parser.parse_known_args()
+
+    backends = ["numpy"]
+    try:
+        import vapoursynth
+        backends.append("scxvid")
+    except ImportError:
+        print("VapourSynth isn't installed, skipping SCXvid", file=sys.stderr)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        clip = args.clip if args.clip is not None else tmp / "clip.mkv"
+        print("Generating clip...", file=sys.stderr)
+        cuts, clip_length = build_clip(clip, args)
+        auto_chap_args = synthetic.get_args(clip, tmp, auto_chap_args)
+        if auto_chap_args.snap is None:
+            auto_chap_args.snap = 1000
+
+        rng = random.Random(args.seed)
+        target_frames = [rng.randrange(1, clip_length) for _ in range(args.targets)]
+        fps = 24000 / 1001
+        snap_window_frames = round(auto_chap_args.snap / 1000 * fps)
+        expected = [get_expected_snap(frame, set(cuts), snap_window_frames, clip_length) for frame in target_frames]
+
+        detected = {}
+        snapped = {}
+        for backend in backends:
+            detected[backend], scan_seconds = scan_clip(backend, auto_chap_args, args.chunk)
+            snapped[backend], snap_seconds, scanned = snap_targets(backend, auto_chap_args, target_frames)
+            results[backend] = score_cuts(detected[backend], cuts)
+            results[backend].update({
+                "scan_seconds": round(scan_seconds, 3),
+                "scan_fps": round(clip_length / scan_seconds, 1),
+                "snap_seconds": round(snap_seconds, 3),
+                "snap_frames_scanned": scanned,
+                "snap_correct": round(sum(frame == expected_frame for (frame, expected_frame) in zip(snapped[backend], expected)) / len(expected), 3),
+            })
+            print(f"{backend:<7} recall {results[backend]['recall']:.0%}  precision {results[backend]['precision']:.0%}"
+                  f"  scan {results[backend]['scan_fps']:7.1f} fps  snap {snap_seconds:6.2f}s ({scanned} frames)"
+                  f"  snapped like the real cuts {results[backend]['snap_correct']:.0%}", file=sys.stderr)
+
+        if len(backends) == 2:
+            both = [frame for frame in detected["numpy"] if any(abs(frame - other) <= TOLERANCE for other in detected["scxvid"])]
+            results["agreement"] = {
+                "cuts": round(len(both) / max(len(detected["numpy"]) + len(detected["scxvid"]) - len(both), 1), 3),
+                "snaps": round(sum(a == b for (a, b) in zip(snapped["numpy"], snapped["scxvid"])) / len(target_frames), 3),
+            }
+            print(f"agreement  cuts {results['agreement']['cuts']:.0%}  snaps {results['agreement']['snaps']:.0%}", file=sys.stderr)
+
+    if args.json is not None:
+        with open(args.json, "w") as outfile:
+            json.dump({"config": {key: value for (key, value) in vars(args).items() if key != "json"},
+                       "cuts": cuts, "results": results}, outfile, indent=4, default=str)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import sys
+import subprocess
+from pathlib import Path
+import numpy as np
+
+# Synthetic themes and episodes for the benchmarks so they don't need any real anime
+
+SAMPLE_RATE = 48000
+THEME_LENGTH = 90
+NOTES = [110, 147, 165, 196, 220, 262, 294, 330, 392, 440]
+
+
+def make_theme(seconds, seed, sr=SAMPLE_RATE):
+    # Plucked notes with a noise burst on each beat, every seed gets its own tempo and key so themes don't match each other
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(seconds * sr)) / sr
+    y = np.zeros_like(t)
+    beat = rng.uniform(0.3, 0.7)
+    key = rng.uniform(0.8, 1.25)
+    for i in range(int(seconds / beat)):
+        freq = rng.choice(NOTES) * rng.choice([1, 2]) * key
+        start = int(i * beat * sr)
+        end = min(len(t), start + int(beat * sr))
+        envelope = np.exp(-np.arange(end - start) / sr * 4)
+        y[start:end] += 0.3 * envelope * np.sin(2 * np.pi * freq * t[start:end])
+        y[start:end] += 0.15 * envelope * np.sin(2 * np.pi * freq * 1.5 * t[start:end])
+        burst = min(2000, end - start)
+        y[start:start + burst] += 0.2 * rng.standard_normal(burst) * np.exp(-np.arange(burst) / 300)
+    return y.astype(np.float32)
+
+
+def make_speech(seconds, seed, sr=SAMPLE_RATE):
+    # Voiced syllables with gliding pitch and pauses between phrases, close enough to dialogue for matching
+    rng = np.random.default_rng(seed)
+    y = np.zeros(int(seconds * sr), dtype=np.float32)
+    position = 0
+    while position < len(y):
+        for _ in range(rng.integers(3, 12)):
+            length = int(rng.uniform(0.12, 0.3) * sr)
+            end = min(len(y), position + length)
+            progress = np.arange(end - position) / length
+            pitch = rng.uniform(100, 220) * (1 + rng.uniform(-0.15, 0.15) * progress)
+            phase = 2 * np.pi * np.cumsum(pitch) / sr
+            envelope = np.sin(np.pi * progress) ** 2
+            syllable = sum(np.sin(harmonic * phase) / harmonic for harmonic in range(1, 8))
+            y[position:end] += (0.15 * envelope * syllable).astype(np.float32)
+            position = end + int(rng.uniform(0.02, 0.08) * sr)
+            if position >= len(y):
+                break
+        position += int(rng.uniform(0.3, 1.5) * sr)
+    return y
+
+
+def equalize(y, low_gain, high_gain, crossover=1000, sr=SAMPLE_RATE):
+    # Smooth shelf from low_gain below the crossover to high_gain above it, like a different master of the song
+    spectrum = np.fft.rfft(y)
+    freqs = np.fft.rfftfreq(len(y), 1 / sr)
+    shelf = 1 / (1 + (freqs / crossover) ** 2)
+    spectrum *= low_gain * shelf + high_gain * (1 - shelf)
+    return np.fft.irfft(spectrum, len(y)).astype(np.float32)
+
+
+def make_episode(seconds, themes, seed=0, noise=0.05, speech=None, sr=SAMPLE_RATE):
+    # Background noise and optional speech with each (theme audio, start second, gain) mixed in
+    # Themes starting before 0 or running past the end get cut off
+    rng = np.random.default_rng(seed)
+    y = noise * rng.standard_normal(int(seconds * sr)).astype(np.float32)
+    if speech is not None:
+        y += speech * make_speech(seconds, seed, sr)
+    for (theme, start, gain) in themes:
+        start = int(start * sr)
+        skip = max(-start, 0)
+        start = max(start, 0)
+        end = min(len(y), start + len(theme) - skip)
+        y[start:end] += gain * theme[skip:skip + end - start]
+    return y
+
+
+def write_audio(path, y, sr=SAMPLE_RATE, channels=2):
+    # Episodes are written as FLAC in mkv since encoding long ones to Vorbis takes far longer than matching them
+    codec = ["-c:a", "flac"] if str(path).endswith(".mkv") else []
+    data = np.repeat(y[:, None], channels, axis=1).astype(np.float32).tobytes()
+    subprocess.run(["ffmpeg", "-y", "-hide_banner", "-loglevel", "error", "-f", "f32le", "-ar", str(sr),
+                    "-ac", str(channels), "-i", "-"] + codec + [str(path)], input=data, check=True)
+
+
+
+def write_themes(work_path, names, seed):
+    # Themes in a .themes folder with an empty cache like Auto_Chap leaves behind, each one with the next seed
+    themes_path = Path(work_path) / ".themes"
+    (themes_path / "cache").mkdir(parents=True)
+    themes = {}
+    for (number, name) in enumerate(names):
+        themes[name] = make_theme(THEME_LENGTH, seed + number)
+        write_audio(themes_path / f"{name}.ogg", themes[name])
+    return themes_path, themes
+
+
+def get_args(episode, work_path, extra_args):
+    # Goes through Auto_Chap's own parser so every option gets the same default as a real run
+    import Auto_Chap
+    old_argv = sys.argv
+    sys.argv = ["Auto_Chap.py", "--input", str(episode), "--work-path", str(work_path)] + extra_args
+    try:
+        return Auto_Chap.parse_args()
+    finally:
+        sys.argv = old_argv
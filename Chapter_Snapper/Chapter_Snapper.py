@@ -1,5 +1,6 @@
-# Chapter Snapper V2.7
+# Chapter Snapper V2.8
 import sys
+import json
 import bisect
 import math
 import re
@@ -16,7 +17,7 @@ def parse_args():
 
     parser.add_argument(
         "--keyframes", "-kf", type=Path,
-        help="SCXvid keyframes. Try to have minimal mkv delay or it might not line up.",
+        help="SCXvid keyframes or the scene change .json Auto_Chap saves in .themes/snap when snapping. The .json only has the frames Auto_Chap checked so chapters with unchecked frames closer than the nearest scene change don't get snapped. Try to have minimal mkv delay or it might not line up.",
     )
 
     parser.add_argument(
@@ -67,16 +68,27 @@ def parse_srt_time(string):
 def parse_scxvid_keyframes(text):
     return [i-3 for i,line in enumerate(text.splitlines()) if line and line[0] == "i"]
 
+def parse_auto_chap_scene_changes(text):
+    # Only has the frames Auto_Chap checked around its chapters and it stops at the nearest scene change,
+    # so the checked frames are kept to know where a missing scene change really means there isn't one
+    frames = json.loads(text)["frames"]
+    return sorted(int(frame) for frame, scene_change in frames.items() if scene_change), {int(frame) for frame in frames}
+
 def parse_keyframes(path):
+    # Scanned frames are None when every frame of the video is known
     with open(path) as file_object:
         text = file_object.read()
-    if text.find("# XviD 2pass stat file")>=0:
+    scanned_frames = None
+    if path.suffix.lower() == ".json":
+        frames, scanned_frames = parse_auto_chap_scene_changes(text)
+        scanned_frames.add(0)
+    elif text.find("# XviD 2pass stat file")>=0:
         frames = parse_scxvid_keyframes(text)
     else:
         raise Exception("Unsupported keyframes type")
     if 0 not in frames:
         frames.insert(0, 0)
-    return frames
+    return frames, scanned_frames
 
 class Timecodes(object):
     TIMESTAMP_END = 1
@@ -175,12 +187,20 @@ def get_closest_kf(frame, keyframes):
         return keyframes[idx]
     return keyframes[idx-1]
 
+def get_unscanned_distance(frame, scanned_frames, max_distance):
+    # Frames away from the nearest frame that wasn't checked for a scene change, None if all were
+    for distance in range(max_distance + 1):
+        for actual_frame in (frame - distance, frame + distance):
+            if actual_frame >= 0 and actual_frame not in scanned_frames:
+                return distance
+    return None
+
 def validate_chapters(chapter_read):
     if not chapter_read[0].startswith("CHAPTER01="):
         print("Invalid chapter format.", file=sys.stderr)
         sys.exit(1)
 
-def apply(chapter_lines, timecodes, keyframes_list, snap_ms, sync, adn=False, ep_duration=0):
+def apply(chapter_lines, timecodes, keyframes_list, snap_ms, sync, adn=False, ep_duration=0, scanned_frames=None):
     # Time adjustments
     for idx, line in enumerate(chapter_lines):
         chapter_split = chapter_lines[idx].split("=")
@@ -197,7 +217,16 @@ def apply(chapter_lines, timecodes, keyframes_list, snap_ms, sync, adn=False, ep
                 closest_frame = get_closest_kf(start_frame, keyframes_list)
                 closest_time = timecodes.get_frame_time(closest_frame, timecodes.TIMESTAMP_START)
 
-                if abs(closest_time - start_ms) <= snap_ms and start_ms != 0:
+                # A closer scene change could be in frames Auto_Chap never checked, like with a bigger window or a sync.
+                # The last frame of the window is left out since Auto_Chap rounds the window edges a frame differently
+                unscanned_distance = None
+                if scanned_frames is not None and start_ms != 0:
+                    window_frames = timecodes.get_frame_number(start_ms + snap_ms, timecodes.TIMESTAMP_START) - start_frame - 1
+                    unscanned_distance = get_unscanned_distance(start_frame, scanned_frames, window_frames)
+                if unscanned_distance is not None and unscanned_distance <= abs(closest_frame - start_frame):
+                    print(f"{chapter_split[0]}: Not snapped, frames in the snap window weren't checked by Auto_Chap. "
+                          "Use the same snap window and sync as Auto_Chap or SCXvid keyframes", file=sys.stderr)
+                elif abs(closest_time - start_ms) <= snap_ms and start_ms != 0:
                     start_ms = max(0, closest_time)
             timesec = start_ms/1000
             timestamp = time.strftime(f"%H:%M:%S.{round(timesec%1*1000):03}", time.gmtime(timesec))
@@ -257,15 +286,15 @@ def main():
     timecodes = Timecodes.cfr(args.fps)
 
     if args.snap_ms != 0:
-        keyframes_list = parse_keyframes(args.keyframes)
+        keyframes_list, scanned_frames = parse_keyframes(args.keyframes)
     else:
-        keyframes_list = []
+        keyframes_list, scanned_frames = [], None
 
     with open(args.input, "r") as chapter_file:
         chapter_lines = chapter_file.readlines()
 
     validate_chapters(chapter_lines)
-    chapter_lines = apply(chapter_lines, timecodes, keyframes_list, args.snap_ms, args.sync, args.adn, args.ep_duration)
+    chapter_lines = apply(chapter_lines, timecodes, keyframes_list, args.snap_ms, args.sync, args.adn, args.ep_duration, scanned_frames)
 
     with open(args.output, "w") as out_file:
         out_file.writelines(chapter_lines)